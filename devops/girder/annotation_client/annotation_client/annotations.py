@@ -1,11 +1,20 @@
 import girder_client
 import json
+import struct
+
+import numpy as np
+
+# See server/helpers/export.py in the annotation plugin
+BINARY_FRAME_HEADER = struct.Struct("<III")
+# See server/helpers/pagination.py in the annotation plugin
+CONTINUATION_TOKEN_HEADER = "Girder-Continuation-Token"
 
 PATHS = {
     "annotation": "/upenn_annotation/",
     "multiple_annotations": "/upenn_annotation/multiple",
+    "ingest_annotations": "/upenn_annotation/ingest",
     "annotation_by_id": "/upenn_annotation/{annotationId}",
-    "annotation_by_dataset": "/upenn_annotation?datasetId={datasetId}",
+    "annotation_export": "/upenn_annotation/export",
     "connection": "/annotation_connection/",
     "multiple_connections": "/annotation_connection/multiple",
     "connection_by_id": "/annotation_connection/{connectionId}",
@@ -37,6 +46,7 @@ PATHS = {
         "&datasetId={datasetId}"
         "&buckets={buckets}"
     ),
+    "histograms": "/annotation_property_values/histograms",
     "dataset_views_by_dataset": "/dataset_view?datasetId={datasetId}",
     "item_by_id": "/item/{itemId}",
 }
@@ -64,24 +74,138 @@ class UPennContrastAnnotationClient:
     # Annotations
 
     def getAnnotationsByDatasetId(
-        self, datasetId, shape=None, tags=None, limit=1_000_000, offset=0
+        self,
+        datasetId,
+        shape=None,
+        tags=None,
+        limit=1_000_000,
+        offset=0,
+        pageSize=None,
     ):
         """
         Get the list of all annotations in the specified dataset
 
         :param str datasetId: The dataset's id
         :param str shape: optional filter by shape
+        :param list tags: optional filter by tags
+        :param int pageSize: optional number of annotations fetched per
+            request. The pages are then fetched with continuation tokens,
+            and limit and offset are ignored.
         :return: A list of annotations
         """
-        url = PATHS["annotation_by_dataset"].format(datasetId=datasetId)
+        if pageSize is not None:
+            return list(
+                self.iterateAnnotationsByDatasetId(
+                    datasetId, shape=shape, tags=tags, pageSize=pageSize
+                )
+            )
+        parameters = self._annotationSearchParameters(datasetId, shape, tags)
+        parameters.update({"limit": limit, "offset": offset})
+        return self.client.get(PATHS["annotation"], parameters=parameters)
 
-        url = f"{url}&limit={limit}&offset{offset}"
+    def iterateAnnotationsByDatasetId(
+        self, datasetId, shape=None, tags=None, pageSize=10_000
+    ):
+        """
+        Iterate over all annotations in the specified dataset, fetching them
+        by pages sorted by id. Each page starts after the last annotation of
+        the previous page, so the cost of a page doesn't depend on its depth.
+
+        :param str datasetId: The dataset's id
+        :param str shape: optional filter by shape
+        :param list tags: optional filter by tags
+        :param int pageSize: The number of annotations fetched per request
+        :return: A generator of annotations
+        """
+        parameters = self._annotationSearchParameters(datasetId, shape, tags)
+        parameters.update({"limit": pageSize, "sort": "_id", "count": "none"})
+        while True:
+            response = self.client.sendRestRequest(
+                "GET",
+                PATHS["annotation"],
+                parameters=parameters,
+                jsonResp=False,
+            )
+            yield from response.json()
+            token = response.headers.get(CONTINUATION_TOKEN_HEADER)
+            if token is None:
+                return
+            parameters["after"] = token
+
+    def _annotationSearchParameters(self, datasetId, shape, tags):
+        parameters = {"datasetId": datasetId}
         if shape:
-            url = f"{url}&shape={shape}"
+            parameters["shape"] = shape
         if tags:
-            url = f"{url}&tags={tags}"
+            # The tags can also be given as a JSON string
+            parameters["tags"] = (
+                tags if isinstance(tags, str) else json.dumps(tags)
+            )
+        return parameters
+
+    def exportAnnotations(self, datasetId, fields=None):
+        """
+        Stream all the annotations of the specified dataset, without paging
+
+        :param str datasetId: The dataset's id
+        :param list fields: optional list of the annotation fields to get
+        :return: A generator of annotations
+        """
+        response = self._requestExport(datasetId, "json", fields)
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
 
-        return self.client.get(url)
+    def exportAnnotationsBinary(self, datasetId, fields=None):
+        """
+        Stream all the annotations of the specified dataset, with their
+        coordinates packed in numpy arrays
+
+        :param str datasetId: The dataset's id
+        :param list fields: optional list of the annotation fields to get
+        :return: A generator of (annotations, offsets, coordinates) tuples,
+            where the coordinates of annotations[i] are
+            coordinates[offsets[i]:offsets[i + 1]], as (x, y, z) rows with z
+            set to NaN when missing
+        """
+        response = self._requestExport(datasetId, "binary", fields)
+        buffer = b""
+        for data in response.iter_content(chunk_size=1 << 20):
+            buffer += data
+            while len(buffer) >= BINARY_FRAME_HEADER.size:
+                metadataLength, annotationCount, coordinateCount = (
+                    BINARY_FRAME_HEADER.unpack_from(buffer)
+                )
+                countsOffset = BINARY_FRAME_HEADER.size + metadataLength
+                coordinatesOffset = countsOffset + 4 * annotationCount
+                frameLength = coordinatesOffset + 24 * coordinateCount
+                if len(buffer) < frameLength:
+                    break
+                annotations = json.loads(
+                    buffer[BINARY_FRAME_HEADER.size:countsOffset]
+                )
+                counts = np.frombuffer(
+                    buffer, "<u4", annotationCount, countsOffset
+                )
+                offsets = np.zeros(annotationCount + 1, dtype=np.int64)
+                np.cumsum(counts, out=offsets[1:])
+                coordinates = np.frombuffer(
+                    buffer, "<f8", 3 * coordinateCount, coordinatesOffset
+                ).reshape(-1, 3)
+                buffer = buffer[frameLength:]
+                yield (annotations, offsets, coordinates)
+
+    def _requestExport(self, datasetId, format, fields):
+        parameters = {"datasetId": datasetId, "format": format}
+        if fields is not None:
+            parameters["fields"] = json.dumps(fields)
+        return self.client.sendRestRequest(
+            "GET",
+            PATHS["annotation_export"],
+            parameters=parameters,
+            jsonResp=False,
+            stream=True,
+        )
 
     def getAnnotationById(self, annotationId):
         """
@@ -112,7 +236,7 @@ class UPennContrastAnnotationClient:
         """
         return self.client.post(PATHS["annotation"], json=annotation)
 
-    def createMultipleAnnotations(self, annotations):
+    def createMultipleAnnotations(self, annotations, recordHistory=True):
         """
         Create multiple annotations with the specified metadata.
         The annotations data should match the standard UPennContrast
@@ -123,12 +247,41 @@ class UPennContrastAnnotationClient:
         values in the database.
 
         :param list annotations: The list of annotations metadata
+        :param bool recordHistory: Add the creation to the history of the
+            user, so that it can be undone. Workers creating many annotations
+            should pass False.
         :return: The created annotation object (Note: will contain the _id
             field)
         :rtype: dict
         """
         return self.client.post(
-            PATHS["multiple_annotations"], json=annotations
+            PATHS["multiple_annotations"],
+            parameters={"recordHistory": recordHistory},
+            json=annotations,
+        )
+
+    def ingestAnnotations(self, datasetId, annotations, chunkSize=5000):
+        """
+        Create a large number of annotations in the specified dataset.
+        The annotations are streamed to the server, which creates them by
+        chunks. Unlike createMultipleAnnotations, the created annotations are
+        not returned and the action is not added to the history.
+
+        :param str datasetId: The dataset's id
+        :param annotations: An iterable of annotations metadata, which can be
+            a generator
+        :param int chunkSize: The number of annotations created at once
+        :return: The number of created annotations, in a dict
+        :rtype: dict
+        """
+        lines = (json.dumps(annotation).encode() + b"\n"
+                 for annotation in annotations)
+        return self.client.sendRestRequest(
+            "POST",
+            PATHS["ingest_annotations"],
+            parameters={"datasetId": datasetId, "chunkSize": chunkSize},
+            data=lines,
+            headers={"Content-Type": "application/x-ndjson"},
         )
 
     def deleteMultipleAnnotations(self, annotationIds):
@@ -142,19 +295,24 @@ class UPennContrastAnnotationClient:
             json=annotationIds
         )
 
-    def createMultipleConnections(self, connections):
+    def createMultipleConnections(self, connections, recordHistory=True):
         """
         Create multiple connections with the specified metadata.
         The connections data should match the standard UPennContrast
         connection schema
 
         :param list connections: The list of connections metadata
+        :param bool recordHistory: Add the creation to the history of the
+            user, so that it can be undone. Workers creating many connections
+            should pass False.
         :return: The created connection object (Note: will contain the _id
             field)
         :rtype: dict
         """
         return self.client.post(
-            PATHS["multiple_connections"], json=connections
+            PATHS["multiple_connections"],
+            parameters={"recordHistory": recordHistory},
+            json=connections,
         )
 
     def deleteMultipleConnections(self, connectionIds):
@@ -294,7 +452,7 @@ class UPennContrastAnnotationClient:
             PATHS["connection_by_id"].format(connectionId=connectionId)
         )
 
-    def connectToNearest(self, connectTo, annotationsIds):
+    def connectToNearest(self, connectTo, annotationsIds, asynchronous=False):
         """
         Automatically create connections between a list of annotations and the
         nearest annotation of a specified tag.
@@ -302,6 +460,8 @@ class UPennContrastAnnotationClient:
         :param dict connectTo: A dict of connect to nearest specifications for
             tags and layer.
         :param list annotationsIds: Annotation ids to be connected.
+        :param bool asynchronous: Create the connections in a girder job. The
+            job is returned instead of the connections.
         """
         body = {
             "annotationsIds": annotationsIds,
@@ -309,7 +469,11 @@ class UPennContrastAnnotationClient:
             "channelId": connectTo["channel"],
         }
 
-        return self.client.post(PATHS["connect_to_nearest"], json=body)
+        return self.client.post(
+            PATHS["connect_to_nearest"],
+            json=body,
+            parameters={"asynchronous": asynchronous},
+        )
 
     # Properties
     def getPropertyById(self, propertyId):
@@ -391,6 +555,25 @@ class UPennContrastAnnotationClient:
             )
         )
 
+    def getPropertyHistograms(self, propertyPaths, datasetId, buckets=255):
+        """
+        Get the histograms of several properties across all annotations in
+        the specified dataset, computed in a single request
+        :param list propertyPaths: The property paths, see getPropertyHistogram
+        :param str datasetId: The dataset id
+        :param str buckets: The number of buckets in the histograms
+        :return: The list of bins for each property path
+        :rtype: dict
+        """
+        return self.client.get(
+            PATHS["histograms"],
+            parameters={
+                "propertyPaths": json.dumps(propertyPaths),
+                "datasetId": datasetId,
+                "buckets": buckets,
+            },
+        )
+
     def getPropertyValuesForDataset(self, datasetId):
         """
         Get property values for all annotations in the specified dataset
@@ -7,11 +7,17 @@ __email__ = "adrien.boucaud@kitware.com"
 __version__ = "0.0.0"
 
 
+import time
+
+import cherrypy
+from cherrypy.process.plugins import Monitor
+from girder import logger
 from girder.plugin import GirderPlugin
 
 from girder.utility.model_importer import ModelImporter
 
 from . import system
+from .server.helpers.fastjsonschema import schemaCompileStats
 from .server.models.annotation import Annotation as AnnotationModel
 from .server.models.connections import AnnotationConnection as ConnectionModel
 from .server.models.propertyValues import (
@@ -25,12 +31,23 @@ from .server.models.workerPreviews import WorkerPreviewModel as PreviewModel
 from .server.models.datasetView import DatasetView as DatasetViewModel
 from .server.models.history import History as HistoryModel
 from .server.models.documentChange import DocumentChange as DocumentChangeModel
+from .server.models.histogramCache import HistogramCache as HistogramCacheModel
+from .server.models.documentArchive import (
+    DocumentArchive as DocumentArchiveModel,
+)
+
+
+# Seconds between two sweeps of the history
+HISTORY_SWEEP_FREQUENCY = 300
+# Seconds between two indexations of the property values
+PROPERTY_INDEX_FREQUENCY = 3600
 
 
 class UPennContrastAnnotationAPIPlugin(GirderPlugin):
     DISPLAY_NAME = "UPennContrast Annotation Plugin"
 
     def load(self, info):
+        start = time.perf_counter()
         # Laziliy do these imports as they can connect to the database
         from .server.api.annotation import Annotation
         from .server.api.connections import AnnotationConnection
@@ -73,6 +90,16 @@ class UPennContrastAnnotationAPIPlugin(GirderPlugin):
         ModelImporter.registerModel(
             "document_change", DocumentChangeModel, "upenncontrast_annotation"
         )
+        ModelImporter.registerModel(
+            "annotation_property_histogram",
+            HistogramCacheModel,
+            "upenncontrast_annotation",
+        )
+        ModelImporter.registerModel(
+            "document_archive",
+            DocumentArchiveModel,
+            "upenncontrast_annotation",
+        )
 
         info["apiRoot"].upenn_annotation = Annotation()
         info["apiRoot"].annotation_connection = AnnotationConnection()
@@ -84,3 +111,27 @@ class UPennContrastAnnotationAPIPlugin(GirderPlugin):
         info["apiRoot"].history = History()
         info["apiRoot"].user_assetstore = UserAssetstore()
         system.addSystemEndpoints(info["apiRoot"])
+
+        # Cap the number of history entries per user, see History.sweep
+        Monitor(
+            cherrypy.engine,
+            HistoryModel().sweep,
+            frequency=HISTORY_SWEEP_FREQUENCY,
+            name="upenncontrast_annotation.historySweep",
+        ).subscribe()
+        # Index the values of new properties, see indexKnownProperties
+        Monitor(
+            cherrypy.engine,
+            PropertyValuesModel().indexKnownProperties,
+            frequency=PROPERTY_INDEX_FREQUENCY,
+            name="upenncontrast_annotation.propertyIndex",
+        ).subscribe()
+
+        logger.info(
+            "UPennContrast annotation plugin loaded in %.3fs, "
+            "%d schema validators generated and %d loaded from cache in %.3fs",
+            time.perf_counter() - start,
+            schemaCompileStats["generated"],
+            schemaCompileStats["cached"],
+            schemaCompileStats["seconds"],
+        )
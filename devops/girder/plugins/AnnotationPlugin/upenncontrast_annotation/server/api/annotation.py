@@ -6,7 +6,17 @@ from girder.api.describe import Description, describeRoute, autoDescribeRoute
 from girder.api.rest import Resource, loadmodel, setResponseHeader
 from girder.constants import AccessType
 from girder.exceptions import AccessException, RestException
+from girder.models.folder import Folder
+from girder.utility.progress import ProgressContext
 from ..helpers.proxiedModel import recordable, memoizeBodyJson
+from ..helpers.export import binaryChunks, ndjsonChunks
+from ..helpers.ingest import readLines
+from ..helpers.localJobs import scheduleLocalJob
+from ..helpers.pagination import (
+    afterToken,
+    isKeysetPage,
+    setLastIdToken,
+)
 from ..models.annotation import Annotation as AnnotationModel
 
 from bson.objectid import ObjectId
@@ -57,18 +67,20 @@ class Annotation(Resource):
         self.route("DELETE", (":id",), self.delete)
         self.route("GET", (":id",), self.get)
         self.route("GET", (), self.find)
+        self.route("GET", ("export",), self.export)
         self.route("POST", (), self.create)
         self.route("PUT", (":id",), self.update)
         self.route("PUT", ("multiple",), self.updateMultiple)
         self.route("POST", ("compute",), self.compute)
         self.route("POST", ("multiple",), self.createMultiple)
+        self.route("POST", ("ingest",), self.ingest)
         self.route("DELETE", ("multiple",), self.deleteMultiple)
+        self.route("POST", ("geometry",), self.backfillGeometry)
 
     # TODO: anytime a dataset is mentioned, load the dataset and check for
     #   existence and that the user has access to it
     # TODO: creation date, update date, creatorId
     # TODO: find annotations by roi, tag, childOf and parentOf
-    # TODO(performance): smarter indexing
     # TODO(performance): use objectId whenever possible
     # TODO: error handling and documentation
 
@@ -89,13 +101,24 @@ class Annotation(Resource):
 
     @access.user
     @describeRoute(
-        Description("Create multiple new annotations").param(
-            "body", "Annotation Object List", paramType="body"
+        Description("Create multiple new annotations")
+        .param("body", "Annotation Object List", paramType="body")
+        .param(
+            "recordHistory",
+            (
+                "Whether to add the action to the history. Disable it for "
+                "machine-generated writes which don't need to be undone."
+            ),
+            dataType="boolean",
+            default=True,
+            required=False,
         )
     )
     @memoizeBodyJson
     @recordable(
-        "Create multiple annotations", getDatasetIdFromAnnotationListInBody
+        "Create multiple annotations",
+        getDatasetIdFromAnnotationListInBody,
+        optional=True,
     )
     def createMultiple(self, params, *args, **kwargs):
         bodyJson = kwargs["memoizedBodyJson"]
@@ -104,6 +127,64 @@ class Annotation(Resource):
             raise AccessException("User not found", "currentUser")
         return self._annotationModel.createMultiple(currentUser, bodyJson)
 
+    @access.user
+    @autoDescribeRoute(
+        Description("Create many annotations from newline-delimited JSON")
+        .notes(
+            "The request body is read incrementally and the annotations are "
+            "validated and created by chunks, so the memory used doesn't "
+            "depend on the size of the upload. When a chunk is invalid, the "
+            "previous chunks stay created. This action is not added to the "
+            "history."
+        )
+        .param(
+            "body",
+            "One annotation object per line",
+            paramType="body",
+        )
+        .param("datasetId", "The dataset of the annotations")
+        .param(
+            "chunkSize",
+            "The number of annotations created at once",
+            dataType="integer",
+            default=5000,
+            required=False,
+        )
+        .param(
+            "progress",
+            "Whether to record progress on this task.",
+            dataType="boolean",
+            default=False,
+            required=False,
+        )
+        .errorResponse()
+        .errorResponse("Write access was denied for the dataset.", 403)
+    )
+    def ingest(self, body, datasetId, chunkSize, progress):
+        currentUser = self.getCurrentUser()
+        Folder().load(
+            datasetId, user=currentUser, level=AccessType.WRITE, exc=True
+        )
+        if chunkSize < 1:
+            raise RestException("The chunk size must be positive")
+        total = int(cherrypy.request.headers.get("Content-Length", 0))
+        with ProgressContext(
+            progress,
+            user=currentUser,
+            title="Creating annotations",
+            total=total,
+        ) as ctx:
+            created = self._annotationModel.ingest(
+                currentUser,
+                datasetId,
+                readLines(body, onRead=lambda read: ctx.update(current=read)),
+                chunkSize=chunkSize,
+                progress=lambda created: ctx.update(
+                    message="%d annotations created" % created
+                ),
+            )
+        return {"created": created}
+
     @describeRoute(
         Description("Delete an existing annotation")
         .param("id", "The annotation's Id", paramType="path")
@@ -158,7 +239,7 @@ class Annotation(Resource):
     def update(self, upenn_annotation, params, *args, **kwargs):
         bodyJson = kwargs["memoizedBodyJson"]
         upenn_annotation.update(bodyJson)
-        self._annotationModel.update(upenn_annotation)
+        self._annotationModel.update(upenn_annotation, self.getCurrentUser())
 
     @describeRoute(
         Description("Update multiple existing annotation")
@@ -198,6 +279,27 @@ class Annotation(Resource):
             required=False,
             requireArray=True,
         )
+        .param(
+            "count",
+            (
+                "How to count the annotations matching the search: exact sets "
+                "the Girder-Total-Count header, estimate sets the "
+                "Girder-Estimated-Count header from a count cached until the "
+                "dataset is modified, none skips the count"
+            ),
+            required=False,
+            enum=["exact", "estimate", "none"],
+            default="exact",
+        )
+        .param(
+            "after",
+            (
+                "Continuation token from the Girder-Continuation-Token header "
+                "of the previous page. Pages are then sorted by _id and the "
+                "offset is ignored."
+            ),
+            required=False,
+        )
         .pagingParams(defaultSort="_id")
         .errorResponse()
     )
@@ -212,14 +314,37 @@ class Annotation(Resource):
             query["shape"] = params["shape"]
         if params["tags"] is not None and len(params["tags"]) > 0:
             query["tags"] = {"$all": params["tags"]}
-        cursor = self._annotationModel.findWithPermissions(
-            query,
+        user = self.getCurrentUser()
+        pageQuery, sort, offset = afterToken(
+            query, sort, offset, params["after"]
+        )
+        # Check the access to the dataset once for the whole search
+        cursor = self._annotationModel.findInDataset(
+            params["datasetId"],
+            pageQuery,
             sort=sort,
-            user=self.getCurrentUser(),
-            level=AccessType.READ,
+            user=user,
             limit=limit,
             offset=offset,
+            fields={"access": False},
         )
+        if isKeysetPage(sort, limit, offset):
+            # The result is streamed after the headers are sent: find the id
+            # of the last annotation of the page with an _id-only query that
+            # doesn't load the annotations
+            last = list(
+                self._annotationModel.findInDataset(
+                    params["datasetId"],
+                    pageQuery,
+                    sort=sort,
+                    user=user,
+                    limit=1,
+                    offset=limit - 1,
+                    fields=["_id"],
+                )
+            )
+            if len(last) > 0:
+                setLastIdToken(last[0]["_id"])
 
         def generateResult():
             chunk = [b"["]
@@ -231,7 +356,7 @@ class Annotation(Resource):
                 annotation["_id"] = str(annotation["_id"])
                 # We don't need to transmit the access control for
                 # annotations
-                annotation.pop("access")
+                annotation.pop("access", None)
                 # Otherwise, we can use json
                 # chunk.append(json.dumps(annotation, allow_nan=False,
                 #             cls=JsonEncoder, separators=(",", ":")).encode())
@@ -247,10 +372,61 @@ class Annotation(Resource):
             yield b"".join(chunk)
 
         setResponseHeader("Content-Type", "application/json")
-        if callable(getattr(cursor, 'count', None)):
-            cherrypy.response.headers['Girder-Total-Count'] = cursor.count()
+        if params["count"] == "exact":
+            setResponseHeader(
+                "Girder-Total-Count",
+                self._annotationModel.countInDataset(query, user),
+            )
+        elif params["count"] == "estimate":
+            setResponseHeader(
+                "Girder-Estimated-Count",
+                self._annotationModel.countInDataset(query, user, exact=False),
+            )
         return generateResult
 
+    @access.user
+    @autoDescribeRoute(
+        Description("Export all the annotations of a dataset")
+        .notes(
+            "The annotations are streamed without pagination nor total count. "
+            "The json format sends one annotation per line. The binary format "
+            "sends frames of annotations with their coordinates packed in "
+            "float64 buffers, see server/helpers/export.py."
+        )
+        .param("datasetId", "Export the annotations of this dataset")
+        .param(
+            "format",
+            "The format of the export",
+            required=False,
+            enum=["json", "binary"],
+            default="json",
+        )
+        .jsonParam(
+            "fields",
+            "Only export these fields of the annotations",
+            required=False,
+            requireArray=True,
+        )
+        .errorResponse()
+    )
+    def export(self, datasetId, format, fields):
+        if fields is None:
+            projection = {"access": False}
+        else:
+            projection = {field: True for field in fields if field != "access"}
+        cursor = self._annotationModel.findInDataset(
+            datasetId,
+            {"datasetId": datasetId},
+            user=self.getCurrentUser(),
+            fields=projection,
+        )
+
+        if format == "binary":
+            setResponseHeader("Content-Type", "application/octet-stream")
+            return lambda: binaryChunks(cursor)
+        setResponseHeader("Content-Type", "application/x-ndjson")
+        return lambda: ndjsonChunks(cursor)
+
     @access.user
     @describeRoute(
         Description("Get an annotation by its id.").param(
@@ -286,3 +462,24 @@ class Annotation(Resource):
         return self._annotationModel.compute(
             datasetId, bodyJson, self.getCurrentUser()
         )
+
+    @access.admin
+    @autoDescribeRoute(
+        Description(
+            "Compute the centroid and bounding box of the annotations stored "
+            "without them, in a local job"
+        )
+        .param(
+            "datasetId",
+            "Only update the annotations of this dataset",
+            required=False,
+        )
+        .errorResponse()
+    )
+    def backfillGeometry(self, datasetId):
+        return scheduleLocalJob(
+            "backfillAnnotationGeometry",
+            "Compute annotation geometry",
+            self.getCurrentUser(),
+            {"datasetId": datasetId},
+        )
@@ -4,6 +4,8 @@ from girder.api.rest import Resource, loadmodel
 from girder.constants import AccessType
 from girder.exceptions import AccessException
 from ..helpers.proxiedModel import recordable, memoizeBodyJson
+from ..helpers.localJobs import scheduleLocalJob
+from ..helpers.pagination import afterToken, setContinuationToken
 from ..models.connections import AnnotationConnection as ConnectionModel
 from ..models.annotation import Annotation as AnnotationModel
 
@@ -51,6 +53,9 @@ def getDatasetIdFromConnectionIdListInBody(
 
 
 def getDatasetIdFromInfoInBody(self: "AnnotationConnection", *args, **kwargs):
+    if self.boolParam("asynchronous", kwargs["params"], False):
+        # Connections created in a job are not recorded
+        return None
     info = kwargs["memoizedBodyJson"]
     annotationsIdsToConnect = info["annotationsIds"]
     annotationModel: AnnotationModel = AnnotationModel()
@@ -105,13 +110,24 @@ class AnnotationConnection(Resource):
 
     @access.user
     @describeRoute(
-        Description("Create multiple new connections").param(
-            "body", "Connection Object List", paramType="body"
+        Description("Create multiple new connections")
+        .param("body", "Connection Object List", paramType="body")
+        .param(
+            "recordHistory",
+            (
+                "Whether to add the action to the history. Disable it for "
+                "machine-generated writes which don't need to be undone."
+            ),
+            dataType="boolean",
+            default=True,
+            required=False,
         )
     )
     @memoizeBodyJson
     @recordable(
-        "Create multiple connections", getDatasetIdFromConnectionListInBody
+        "Create multiple connections",
+        getDatasetIdFromConnectionListInBody,
+        optional=True,
     )
     def multipleCreate(self, params, *args, **kwargs):
         bodyJson = kwargs["memoizedBodyJson"]
@@ -176,7 +192,7 @@ class AnnotationConnection(Resource):
     def update(self, connection, params, *args, **kwargs):
         bodyJson = kwargs["memoizedBodyJson"]
         connection.update(bodyJson)
-        self._connectionModel.update(connection)
+        self._connectionModel.update(connection, self.getCurrentUser())
 
     @access.user
     @autoDescribeRoute(
@@ -198,6 +214,15 @@ class AnnotationConnection(Resource):
             "Get all connections to or from this annotation",
             required=False,
         )
+        .param(
+            "after",
+            (
+                "Continuation token from the Girder-Continuation-Token header "
+                "of the previous page. Pages are then sorted by _id and the "
+                "offset is ignored."
+            ),
+            required=False,
+        )
         .pagingParams(defaultSort="_id")
         .errorResponse()
     )
@@ -215,14 +240,25 @@ class AnnotationConnection(Resource):
                 {"parentId": params["nodeAnnotationId"]},
                 {"childId": params["nodeAnnotationId"]},
             ]
-        return self._connectionModel.findWithPermissions(
-            query,
-            sort=sort,
-            user=self.getCurrentUser(),
-            level=AccessType.READ,
-            limit=limit,
-            offset=offset,
+        query, sort, offset = afterToken(
+            query, sort, offset, params.get("after")
         )
+        user = self.getCurrentUser()
+        findArgs = dict(
+            sort=sort, limit=limit, offset=offset, fields={"access": False}
+        )
+        if "datasetId" in params and params["datasetId"]:
+            # Check the access to the dataset once for the whole search
+            cursor = self._connectionModel.findInDataset(
+                params["datasetId"], query, user=user, **findArgs
+            )
+        else:
+            cursor = self._connectionModel.findWithPermissions(
+                query, user=user, level=AccessType.READ, **findArgs
+            )
+        connections = list(cursor)
+        setContinuationToken(sort, limit, offset, connections)
+        return connections
 
     @access.user
     @autoDescribeRoute(
@@ -240,8 +276,17 @@ class AnnotationConnection(Resource):
 
     @access.user
     @describeRoute(
-        Description("Create connections between annotations").param(
-            "body", "Connection Object", paramType="body"
+        Description("Create connections between annotations")
+        .param("body", "Connection Object", paramType="body")
+        .param(
+            "asynchronous",
+            (
+                "Create the connections in a local job and return the job "
+                "immediately. These connections are not added to the history."
+            ),
+            dataType="boolean",
+            default=False,
+            required=False,
         )
     )
     @memoizeBodyJson
@@ -251,6 +296,13 @@ class AnnotationConnection(Resource):
         currentUser = self.getCurrentUser()
         if not currentUser:
             raise AccessException("User not found", "currentUser")
+        if self.boolParam("asynchronous", params, False):
+            return scheduleLocalJob(
+                "connectToNearest",
+                "Connect annotations to nearest",
+                currentUser,
+                {"info": bodyJson, "userId": str(currentUser["_id"])},
+            )
         return self._connectionModel.connectToNearest(
             user=currentUser, info=bodyJson
         )
@@ -42,9 +42,12 @@ class History(Resource):
 
     @access.user
     @describeRoute(
-        Description(
-            "Undo the last history entry which hasn't been undone"
-        ).param(
+        Description("Undo the last history entry which hasn't been undone")
+        .notes(
+            "Returns the undone action with the number of document changes "
+            "applied and the time taken in seconds, or null."
+        )
+        .param(
             "datasetId",
             "The dataset in which undo should be done",
             required=True,
@@ -61,7 +64,12 @@ class History(Resource):
 
     @access.user
     @describeRoute(
-        Description("Redo the last history entry which has been undone").param(
+        Description("Redo the last history entry which has been undone")
+        .notes(
+            "Returns the redone action with the number of document changes "
+            "applied and the time taken in seconds, or null."
+        )
+        .param(
             "datasetId",
             "The dataset in which redo should be done",
             required=True,
@@ -74,4 +82,4 @@ class History(Resource):
         if "datasetId" not in params:
             raise RestException(code=400, message="Dataset ID is missing")
         datasetId = ObjectId(params["datasetId"])
-        self._historyModel.redo(user, datasetId)
+        return self._historyModel.redo(user, datasetId)
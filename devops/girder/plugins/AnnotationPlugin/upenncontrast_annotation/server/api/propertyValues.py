@@ -1,14 +1,21 @@
 from girder.api import access
-from girder.api.describe import Description, describeRoute
+from girder.api.describe import Description, autoDescribeRoute, describeRoute
 from girder.constants import AccessType
 from girder.api.rest import Resource
+from ..helpers.localJobs import scheduleLocalJob
+from ..helpers.pagination import afterToken, setContinuationToken
 from ..models.propertyValues import (
     AnnotationPropertyValues as PropertyValuesModel,
 )
 from girder.exceptions import AccessException, RestException
+from girder.models.folder import Folder
 
 
 class PropertyValues(Resource):
+    # Maximum number of property paths of a histograms request, each path is
+    # a facet of the same aggregation
+    maxHistogramPaths = 100
+
     def __init__(self):
         super().__init__()
         self.resourceName = "annotation_property_values"
@@ -19,11 +26,12 @@ class PropertyValues(Resource):
         self.route("POST", ("multiple",), self.addMultiple)
         self.route("GET", (), self.find)
         self.route("GET", ("histogram",), self.histogram)
+        self.route("GET", ("histograms",), self.histograms)
+        self.route("POST", ("index",), self.index)
 
     # TODO: anytime a dataset is mentioned, load the dataset and check for
     #   existence and that the user has access to it
     # TODO: creation date, update date, creatorId ?
-    # TODO(performance): proper indexing
     # TODO(performance): use objectId whenever possible
 
     @access.user
@@ -108,24 +116,44 @@ class PropertyValues(Resource):
             "Get all property values for this annotation",
             required=False,
         )
+        .param(
+            "after",
+            (
+                "Continuation token from the Girder-Continuation-Token header "
+                "of the previous page. Pages are then sorted by _id and the "
+                "offset is ignored."
+            ),
+            required=False,
+        )
         .pagingParams(defaultSort="_id")
         .errorResponse()
     )
     def find(self, params):
         limit, offset, sort = self.getPagingParameters(params, "lowerName")
         query = {}
-        if "datasetId" in params:
+        if "datasetId" in params and params["datasetId"]:
             query["datasetId"] = params["datasetId"]
         if "annotationId" in params:
             query["annotationId"] = params["annotationId"]
-        return self._annotationPropertyValuesModel.findWithPermissions(
-            query,
-            sort=sort,
-            user=self.getCurrentUser(),
-            level=AccessType.READ,
-            limit=limit,
-            offset=offset,
+        query, sort, offset = afterToken(
+            query, sort, offset, params.get("after")
         )
+        user = self.getCurrentUser()
+        findArgs = dict(
+            sort=sort, limit=limit, offset=offset, fields={"access": False}
+        )
+        if "datasetId" in params and params["datasetId"]:
+            # Check the access to the dataset once for the whole search
+            cursor = self._annotationPropertyValuesModel.findInDataset(
+                params["datasetId"], query, user=user, **findArgs
+            )
+        else:
+            cursor = self._annotationPropertyValuesModel.findWithPermissions(
+                query, user=user, level=AccessType.READ, **findArgs
+            )
+        values = list(cursor)
+        setContinuationToken(sort, limit, offset, values)
+        return values
 
     @access.user
     @describeRoute(
@@ -143,6 +171,12 @@ class PropertyValues(Resource):
         .param("buckets", "The number of buckets", required=False)
     )
     def histogram(self, params):
+        Folder().load(
+            params["datasetId"],
+            user=self.getCurrentUser(),
+            level=AccessType.READ,
+            exc=True,
+        )
         if "buckets" in params:
             return self._annotationPropertyValuesModel.histogram(
                 params["propertyPath"],
@@ -153,3 +187,64 @@ class PropertyValues(Resource):
             return self._annotationPropertyValuesModel.histogram(
                 params["propertyPath"], params["datasetId"]
             )
+
+    @access.user
+    @autoDescribeRoute(
+        Description(
+            "Get the histograms of several properties in the specified dataset"
+        )
+        .notes("The histograms are computed in a single aggregation.")
+        .jsonParam(
+            "propertyPaths",
+            (
+                "The paths to the properties: property IDs and eventually "
+                "subIds separated with dots (e.g. propertyId.subId0.subId1)"
+            ),
+            requireArray=True,
+        )
+        .param("datasetId", "The id of the dataset")
+        .param(
+            "buckets",
+            "The number of buckets",
+            dataType="integer",
+            default=255,
+            required=False,
+        )
+        .errorResponse()
+        .errorResponse("Read access was denied for the dataset.", 403)
+    )
+    def histograms(self, propertyPaths, datasetId, buckets):
+        currentUser = self.getCurrentUser()
+        Folder().load(
+            datasetId, user=currentUser, level=AccessType.READ, exc=True
+        )
+        if buckets < 1:
+            raise RestException("The number of buckets must be positive")
+        if len(propertyPaths) > self.maxHistogramPaths:
+            raise RestException(
+                "At most %d property paths can be requested"
+                % self.maxHistogramPaths
+            )
+        if not all(isinstance(path, str) for path in propertyPaths):
+            raise RestException("The property paths must be strings")
+        return self._annotationPropertyValuesModel.histograms(
+            propertyPaths, datasetId, buckets
+        )
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Index the property values used by histograms")
+        .notes(
+            "Schedules a local job creating an index for the value paths of "
+            "each known property. This also runs periodically in the "
+            "background."
+        )
+        .errorResponse()
+    )
+    def index(self):
+        return scheduleLocalJob(
+            "indexPropertyValues",
+            "Index property values",
+            self.getCurrentUser(),
+            {},
+        )
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class DatasetCache:
+    """
+    An in-memory cache of values grouped by dataset, so that all the values of
+    a dataset can be invalidated at once when the dataset is modified.
+    The least recently used datasets are evicted when there are more than
+    maxDatasets datasets in the cache.
+    The cache is local to the process: values are only estimates when several
+    girder processes share the database.
+    """
+
+    def __init__(self, maxDatasets=256):
+        self.maxDatasets = maxDatasets
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, datasetId, key, default=None):
+        datasetId = str(datasetId)
+        with self._lock:
+            values = self._datasets.get(datasetId)
+            if values is None or key not in values:
+                return default
+            self._datasets.move_to_end(datasetId)
+            return values[key]
+
+    def set(self, datasetId, key, value):
+        datasetId = str(datasetId)
+        with self._lock:
+            self._datasets.setdefault(datasetId, {})[key] = value
+            self._datasets.move_to_end(datasetId)
+            while len(self._datasets) > self.maxDatasets:
+                self._datasets.popitem(last=False)
+
+    def invalidate(self, datasetIds):
+        with self._lock:
+            for datasetId in datasetIds:
+                self._datasets.pop(str(datasetId), None)
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+
+
+class ExpiringIdCache:
+    """
+    A bounded set of ids which are forgotten after ttl seconds, and in least
+    recently added order when there are more than maxSize ids.
+    """
+
+    def __init__(self, maxSize=4096, ttl=60):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._expirations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, id):
+        with self._lock:
+            expiration = self._expirations.get(str(id))
+            if expiration is None:
+                return False
+            if expiration < time.monotonic():
+                del self._expirations[str(id)]
+                return False
+            return True
+
+    def add(self, ids):
+        expiration = time.monotonic() + self.ttl
+        with self._lock:
+            for id in ids:
+                self._expirations[str(id)] = expiration
+                self._expirations.move_to_end(str(id))
+            while len(self._expirations) > self.maxSize:
+                self._expirations.popitem(last=False)
+
+    def discard(self, ids):
+        with self._lock:
+            for id in ids:
+                self._expirations.pop(str(id), None)
+
+    def clear(self):
+        with self._lock:
+            self._expirations.clear()
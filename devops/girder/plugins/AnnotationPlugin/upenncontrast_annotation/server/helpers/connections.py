@@ -1,6 +1,12 @@
 import math
 import numpy as np
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # scipy is optional, nearestNeighbours falls back to numpy
+    cKDTree = None
+
 
 def pointToPointDistance(coord1, coord2):
     """Get the distance between two points using points coordinates.
@@ -38,20 +44,99 @@ def simpleCentroid(listCoordinates):
         dict: Coordinates of the centroid
     """
     nbCoordinates = len(listCoordinates)
-    x = np.sum([coord["x"] for coord in listCoordinates]) / nbCoordinates
-    y = np.sum([coord["y"] for coord in listCoordinates]) / nbCoordinates
+    sumX = sumY = sumZ = 0
+    hasZ = True
+    for coord in listCoordinates:
+        sumX += coord["x"]
+        sumY += coord["y"]
+        if hasZ and "z" in coord:
+            sumZ += coord["z"]
+        else:
+            hasZ = False
     centroid = {
-        "x": x,
-        "y": y,
+        "x": sumX / nbCoordinates,
+        "y": sumY / nbCoordinates,
     }
 
-    if all(["z" in coord for coord in listCoordinates]):
-        z = np.sum([coord["z"] for coord in listCoordinates]) / nbCoordinates
-        centroid["z"] = z
+    if hasZ:
+        centroid["z"] = sumZ / nbCoordinates
 
     return centroid
 
 
+def boundingBox(listCoordinates):
+    """Compute the axis aligned bounding box of a list of coordinates.
+    Compute the bounds for z coordinate iff all points have z
+
+    Args:
+        listCoordinates (dict[]): List of point coordinates.
+          Point coordinates are represented by:
+          {x: x_coord, y: y_coord, z?: z_coord}
+
+    Returns:
+        dict: {xmin, ymin, xmax, ymax, zmin?, zmax?}
+    """
+    axes = ("x", "y", "z")
+    if not all("z" in coord for coord in listCoordinates):
+        axes = ("x", "y")
+    box = {}
+    for axis in axes:
+        values = [coord[axis] for coord in listCoordinates]
+        box[axis + "min"] = float(min(values))
+        box[axis + "max"] = float(max(values))
+    return box
+
+
+def computeAnnotationCentroid(annotation):
+    """Compute the centroid of an annotation from its coordinates.
+    The centroid of a point is the point itself, the centroid of any other
+    shape is the barycenter of its coordinates (see simpleCentroid).
+
+    Args:
+        annotation (dict): The annotation, with its list of coordinates
+
+    Returns:
+        dict: Coordinates of the centroid, with float values
+    """
+    if isAPoint(annotation):
+        centroid = annotation["coordinates"][0]
+    else:
+        centroid = simpleCentroid(annotation["coordinates"])
+    return {axis: float(centroid[axis]) for axis in ("x", "y", "z")
+            if axis in centroid}
+
+
+def annotationCentroid(annotation):
+    """Get the centroid of an annotation.
+    Use the centroid stored in the annotation when it has been computed at
+    write time, compute it from the coordinates otherwise.
+
+    Args:
+        annotation (dict): The annotation
+
+    Returns:
+        dict: Coordinates of the centroid
+    """
+    centroid = annotation.get("centroid", None)
+    if centroid is not None:
+        return centroid
+    return computeAnnotationCentroid(annotation)
+
+
+def xyDistance(coord1, coord2):
+    """Get the XY distance between two points, a lower bound of
+    pointToPointDistance.
+
+    Args:
+        coord1 (dict): Coordinates of point 1
+        coord2 (dict): Coordinates of point 2
+
+    Returns:
+        Number: XY distance between point1 and point2
+    """
+    return math.hypot(coord1["x"] - coord2["x"], coord1["y"] - coord2["y"])
+
+
 def isAPoint(annotation):
     return annotation["shape"] == "point"
 
@@ -82,14 +167,105 @@ def annotationToAnnotationDistance(annotation1, annotation2):
     ):
         point = annotation1 if isAPoint(annotation1) else annotation2
         poly = annotation1 if isAPoly(annotation1) else annotation2
-        centroid = simpleCentroid(poly["coordinates"])
+        centroid = annotationCentroid(poly)
 
         return pointToPointDistance(point["coordinates"][0], centroid)
 
     # Poly to poly
     if isAPoly(annotation1) and isAPoly(annotation2):
-        centroid1 = simpleCentroid(annotation1["coordinates"])
-        centroid2 = simpleCentroid(annotation2["coordinates"])
+        centroid1 = annotationCentroid(annotation1)
+        centroid2 = annotationCentroid(annotation2)
         return pointToPointDistance(centroid1, centroid2)
 
     return math.inf
+
+
+def centroidsToArray(centroids, axes):
+    """Pack a list of centroids in a numpy array.
+
+    Args:
+        centroids (dict[]): List of centroids {x: x_coord, y: y_coord, z?}
+        axes (str[]): The axes to keep, e.g. ("x", "y") or ("x", "y", "z")
+
+    Returns:
+        np.ndarray: Array of shape (len(centroids), len(axes))
+    """
+    array = np.empty((len(centroids), len(axes)), dtype=np.float64)
+    for i, centroid in enumerate(centroids):
+        array[i] = [centroid[axis] for axis in axes]
+    return array
+
+
+def nearestNeighbours(queryPoints, points, maxChunkBytes=64 * 1024 * 1024):
+    """For each query point, find the nearest point.
+    Uses a KD-tree when scipy is available, otherwise computes the distances
+    with numpy by chunks of query points to bound the memory usage.
+
+    Args:
+        queryPoints (np.ndarray): Array of shape (nQueries, dimension)
+        points (np.ndarray): Array of shape (nPoints, dimension), nPoints > 0
+        maxChunkBytes (int): Memory budget of a chunk of distances
+
+    Returns:
+        Tuple(np.ndarray, np.ndarray): For each query point, the index of the
+            nearest point and the distance to it
+    """
+    if cKDTree is not None:
+        distances, indices = cKDTree(points).query(queryPoints)
+        return indices, distances
+    nQueries = len(queryPoints)
+    indices = np.empty(nQueries, dtype=np.intp)
+    distances = np.empty(nQueries, dtype=np.float64)
+    chunkSize = max(1, maxChunkBytes // (8 * points.size))
+    for start in range(0, nQueries, chunkSize):
+        chunk = queryPoints[start:start + chunkSize]
+        squareDistances = (
+            (chunk[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2
+        ).sum(axis=2)
+        chunkIndices = np.argmin(squareDistances, axis=1)
+        indices[start:start + chunkSize] = chunkIndices
+        distances[start:start + chunkSize] = np.sqrt(
+            squareDistances[np.arange(len(chunk)), chunkIndices]
+        )
+    return indices, distances
+
+
+def nearestCentroids(queryCentroids, centroids):
+    """For each query centroid, find the nearest centroid using the distance
+    of pointToPointDistance: the z coordinate is only used when both
+    centroids have one.
+
+    Args:
+        queryCentroids (dict[]): List of centroids {x, y, z?}
+        centroids (dict[]): List of centroids {x, y, z?}, not empty
+
+    Returns:
+        Tuple(np.ndarray, np.ndarray): For each query centroid, the index of
+            the nearest centroid and the distance to it
+    """
+    indices = np.zeros(len(queryCentroids), dtype=np.intp)
+    distances = np.full(len(queryCentroids), np.inf)
+    queryHasZ = np.array(["z" in centroid for centroid in queryCentroids])
+    hasZ = np.array(["z" in centroid for centroid in centroids])
+    # Queries with z: XYZ distance to the centroids with z, XY distance to
+    # the other ones. Queries without z: XY distance to all the centroids.
+    groups = [
+        (queryHasZ, hasZ, ("x", "y", "z")),
+        (queryHasZ, ~hasZ, ("x", "y")),
+        (~queryHasZ, np.ones(len(centroids), dtype=bool), ("x", "y")),
+    ]
+    for queryMask, mask, axes in groups:
+        queryIndices = np.flatnonzero(queryMask)
+        candidateIndices = np.flatnonzero(mask)
+        if len(queryIndices) == 0 or len(candidateIndices) == 0:
+            continue
+        nearest, nearestDistances = nearestNeighbours(
+            centroidsToArray(
+                [queryCentroids[i] for i in queryIndices], axes
+            ),
+            centroidsToArray([centroids[i] for i in candidateIndices], axes),
+        )
+        closer = nearestDistances < distances[queryIndices]
+        distances[queryIndices[closer]] = nearestDistances[closer]
+        indices[queryIndices[closer]] = candidateIndices[nearest[closer]]
+    return indices, distances
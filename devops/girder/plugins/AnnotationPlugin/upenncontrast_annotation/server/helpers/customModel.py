@@ -1,16 +1,178 @@
 from girder import events
+from girder.constants import AccessType
 from girder.exceptions import ValidationException
+from girder.models.folder import Folder
 from girder.models.model_base import AccessControlledModel
+from girder.models.setting import Setting
 
-from pymongo.errors import BulkWriteError, WriteError
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
 
+from ..settings import PluginSettings
+
+
+def queryDatasetIds(query):
+    """
+    Get the dataset ids a query is restricted to, or None if the query isn't
+    restricted to some datasets.
+    """
+    if not query:
+        return None
+    value = query.get("datasetId", None)
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict) and list(value.keys()) == ["$in"]:
+        return list(value["$in"])
+    for clause in query.get("$and", []):
+        datasetIds = queryDatasetIds(clause)
+        if datasetIds is not None:
+            return datasetIds
+    return None
+
 
 class CustomAccessControlledModel(AccessControlledModel):
+    # Number of documents written by each bulk_write of saveMany
+    saveManyChunkSize = 5000
+    # Whether the documents can inherit the access of their dataset folder
+    # See PluginSettings.INHERIT_DATASET_ACCESS
+    datasetAccessInheritable = False
+
+    def inheritsDatasetAccess(self):
+        return self.datasetAccessInheritable and Setting().get(
+            PluginSettings.INHERIT_DATASET_ACCESS
+        )
+
+    def setCreatorAccess(self, document, creator):
+        """
+        Give admin access on a new document to its creator. The access list
+        is stored even when the access is inherited from the dataset, so that
+        the creator keeps its access if the inheritance is disabled.
+        """
+        if creator is not None:
+            self.setUserAccess(
+                document, user=creator, level=AccessType.ADMIN, save=False
+            )
+        return document
+
+    def checkDatasetWriteAccess(self, documents, user):
+        """
+        Check that the user can write in the datasets of documents created or
+        updated by this user, when the access of the documents is inherited
+        from their dataset. Without inheritance, a new document is only
+        accessible to its creator so there is nothing to check.
+
+        :param documents: The documents to create or update
+        :param user: The user writing the documents, None for internal writes
+        :raises AccessException: If the user can't write in a dataset
+        """
+        if user is None or not self.inheritsDatasetAccess():
+            return
+        datasetIds = set(
+            document["datasetId"]
+            for document in documents
+            if "datasetId" in document
+        )
+        for datasetId in datasetIds:
+            Folder().load(
+                datasetId, user=user, level=AccessType.WRITE, exc=True
+            )
+
+    def hasDatasetAccess(self, datasetId, user=None, level=AccessType.READ):
+        folder = Folder().load(datasetId, force=True)
+        return folder is not None and Folder().hasAccess(folder, user, level)
+
+    def hasAccess(self, doc, user=None, level=AccessType.READ):
+        if self.inheritsDatasetAccess():
+            return self.hasDatasetAccess(doc["datasetId"], user, level)
+        return super().hasAccess(doc, user, level)
+
+    def accessQuery(self, query, user=None, level=AccessType.READ):
+        """
+        Restrict a query to the documents that the user can access.
+        When the access is inherited from the datasets, the access to each
+        dataset of the query is checked once instead of filtering each
+        document.
+        """
+        if level is None or (user and user["admin"]):
+            return query
+        if not self.inheritsDatasetAccess():
+            return {"$and": [query or {}, self.permissionClauses(user, level)]}
+        datasetIds = queryDatasetIds(query)
+        fromQuery = datasetIds is not None
+        if not fromQuery:
+            datasetIds = self.collection.distinct("datasetId", query or {})
+        allowedIds = [
+            datasetId
+            for datasetId in datasetIds
+            if self.hasDatasetAccess(datasetId, user, level)
+        ]
+        if fromQuery and len(allowedIds) == len(datasetIds):
+            return query
+        return {"$and": [query or {}, {"datasetId": {"$in": allowedIds}}]}
+
+    def findWithPermissions(
+        self,
+        query=None,
+        offset=0,
+        limit=0,
+        timeout=None,
+        fields=None,
+        sort=None,
+        user=None,
+        level=AccessType.READ,
+        **kwargs
+    ):
+        return self.find(
+            query=self.accessQuery(query, user, level),
+            offset=offset,
+            limit=limit,
+            timeout=timeout,
+            fields=fields,
+            sort=sort,
+            **kwargs
+        )
+
+    def findInDataset(
+        self, datasetId, query, user=None, level=AccessType.READ, **kwargs
+    ):
+        """
+        Search the documents of a dataset. When the access of the documents is
+        inherited from the dataset, the access to the dataset folder is
+        checked once and the query is run as is, without filtering each
+        document. Otherwise, this is findWithPermissions.
+
+        :param datasetId: The id of the dataset folder
+        :param query: The search query, restricted to the dataset
+        :param kwargs: Passed to find: fields, sort, limit, offset...
+        :raises AccessException: If the access is inherited and the user
+            can't access the dataset
+        :returns: A pymongo Cursor
+        """
+        if not self.inheritsDatasetAccess():
+            return self.findWithPermissions(
+                query, user=user, level=level, **kwargs
+            )
+        Folder().load(datasetId, user=user, level=level, exc=True)
+        return self.find(query, **kwargs)
+
+    def countWithPermissions(self, query=None, user=None,
+                             level=AccessType.READ):
+        """
+        Count the documents matching the query that the user can access, see
+        findWithPermissions.
+        """
+        query = self.accessQuery(query, user, level)
+        return self.collection.count_documents(query or {})
+
     def saveMany(self, documents, validate=True, triggerEvents=True):
         """
         Create or update several documents in the collection. If a single
         document fails the validation, no document is added or removed.
+        The documents are written by chunks though, so a database write error
+        can leave a partial write: the earlier chunks and the other documents
+        of the failing chunk are saved, and the post-save event is triggered
+        for them before raising.
         This triggers two events; one prior to validation, and one prior to
         saving. Either of these events may have their default action
         prevented.
@@ -43,34 +205,67 @@ class CustomAccessControlledModel(AccessControlledModel):
             if event.defaultPrevented:
                 return documents
 
-        idsToRemove = [
-            ObjectId(document["_id"])
-            for document in documents
-            if "_id" in document
-        ]
-        if len(idsToRemove) > 0:
-            try:
-                self.removeWithQuery({"_id": {"$in": idsToRemove}})
-            except WriteError as e:
-                raise ValidationException(
-                    "Database save many failed while deleting duplicate keys: "
-                    + e.details
-                )
-
-        try:
-            documentIds = self.collection.insert_many(documents).inserted_ids
-        except BulkWriteError as e:
-            raise ValidationException(
-                "Database save many failed: " + e.details
-            )
-
-        for document, documentId in zip(documents, documentIds):
-            document["_id"] = documentId
+        replacedIds = self.writeMany(documents, triggerEvents)
 
         if triggerEvents:
-            events.trigger(
-                "model.%s.saveMany.after" % self.name,
-                {"newDocuments": documents, "removedIds": idsToRemove},
-            )
+            self.triggerSaveManyAfter(documents, replacedIds)
 
         return documents
+
+    def triggerSaveManyAfter(self, documents, replacedIds):
+        # removedIds are the ids of the replaced documents
+        events.trigger(
+            "model.%s.saveMany.after" % self.name,
+            {"newDocuments": documents, "removedIds": replacedIds},
+        )
+
+    def writeMany(self, documents, triggerEvents=True):
+        """
+        Replace the documents with an _id and insert the other ones, using
+        unordered bulk writes by chunks of saveManyChunkSize documents.
+        When a chunk fails, the documents written so far are reported with the
+        post-save event (if triggerEvents) so that caches stay consistent.
+
+        :returns: The ids of the replaced documents
+        :raises ValidationException: If a bulk write fails
+        """
+        replacedIds = []
+        requests = []
+        for document in documents:
+            if "_id" in document:
+                document["_id"] = ObjectId(document["_id"])
+                replacedIds.append(document["_id"])
+                requests.append(
+                    ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+                )
+            else:
+                document["_id"] = ObjectId()
+                requests.append(InsertOne(document))
+
+        for start in range(0, len(requests), self.saveManyChunkSize):
+            try:
+                self.collection.bulk_write(
+                    requests[start:start + self.saveManyChunkSize],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                if triggerEvents:
+                    failed = set(
+                        error["index"]
+                        for error in e.details.get("writeErrors", [])
+                    )
+                    chunk = documents[start:start + self.saveManyChunkSize]
+                    written = documents[:start] + [
+                        document
+                        for index, document in enumerate(chunk)
+                        if index not in failed
+                    ]
+                    writtenIds = set(document["_id"] for document in written)
+                    self.triggerSaveManyAfter(
+                        written,
+                        [id for id in replacedIds if id in writtenIds],
+                    )
+                raise ValidationException(
+                    "Database save many failed: " + str(e.details)
+                )
+        return replacedIds
@@ -0,0 +1,90 @@
+import math
+import struct
+
+import numpy as np
+import orjson
+
+exportChunkSize = 1000
+
+# Each frame of the binary export starts with this header:
+# metadata length in bytes, number of annotations, number of coordinates
+# It is followed by:
+# - the metadata: a JSON list of the annotations without their coordinates
+# - the number of coordinates of each annotation, as little endian uint32
+# - the coordinates, as little endian float64 x, y, z triplets (z is NaN when
+#   the coordinate doesn't have one)
+binaryFrameHeader = struct.Struct("<III")
+
+
+def prepareForExport(annotation):
+    # orjson won't serialize ObjectIds
+    annotation["_id"] = str(annotation["_id"])
+    # We don't need to transmit the access control for annotations
+    annotation.pop("access", None)
+    return annotation
+
+
+def chunked(cursor, chunkSize):
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def ndjsonChunks(cursor, chunkSize=exportChunkSize):
+    """
+    Encode the documents of the cursor as newline-delimited JSON
+    """
+    for chunk in chunked(cursor, chunkSize):
+        yield b"".join(
+            orjson.dumps(prepareForExport(annotation)) + b"\n"
+            for annotation in chunk
+        )
+
+
+def packCoordinates(annotations):
+    """
+    Remove the coordinates from the annotations and pack them in an array
+
+    :returns: A tuple (counts, coordinates) where counts is the number of
+        coordinates of each annotation and coordinates a (N, 3) array
+    """
+    counts = np.zeros(len(annotations), dtype="<u4")
+    packed = []
+    for i, annotation in enumerate(annotations):
+        coordinates = annotation.pop("coordinates", None) or []
+        counts[i] = len(coordinates)
+        packed.extend(
+            (
+                coordinate["x"],
+                coordinate["y"],
+                coordinate.get("z", math.nan),
+            )
+            for coordinate in coordinates
+        )
+    return (counts, np.array(packed, dtype="<f8").reshape(-1, 3))
+
+
+def binaryChunks(cursor, chunkSize=exportChunkSize):
+    """
+    Encode the documents of the cursor as binary frames, see binaryFrameHeader
+    """
+    for chunk in chunked(cursor, chunkSize):
+        counts, coordinates = packCoordinates(chunk)
+        metadata = orjson.dumps(
+            [prepareForExport(annotation) for annotation in chunk]
+        )
+        yield b"".join(
+            [
+                binaryFrameHeader.pack(
+                    len(metadata), len(chunk), len(coordinates)
+                ),
+                metadata,
+                counts.tobytes(),
+                coordinates.tobytes(),
+            ]
+        )
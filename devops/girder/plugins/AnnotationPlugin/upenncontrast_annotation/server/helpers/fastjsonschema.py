@@ -3,6 +3,10 @@ from bson.objectid import ObjectId
 import fastjsonschema
 from functools import partial, update_wrapper
 from datetime import datetime
+import hashlib
+import json
+import os
+import time
 
 
 # ----------------------------------------------------------------
@@ -38,6 +42,73 @@ fastjsonschema.draft04.JSON_TYPE_TO_PYTHON_TYPE.update(custom_type_classes)
 fastjsonschema.draft06.JSON_TYPE_TO_PYTHON_TYPE.update(custom_type_classes)
 
 
+# ----------------------------------------------------------------
+# On-disk cache of the generated validators
+# ----------------------------------------------------------------
+
+
+# Generating the code of a validator is done for each schema when the models
+# are imported. When UPENN_SCHEMA_CACHE_DIR is set, the generated code is
+# cached in this directory, keyed by a hash of the schema. The cached code is
+# executed, so the directory is created private and is only used while it is
+# owned by the current user and not writable by others.
+schemaCacheDir = os.environ.get("UPENN_SCHEMA_CACHE_DIR", "")
+
+# Statistics of the compiled validators, logged when the plugin is loaded
+schemaCompileStats = {"generated": 0, "cached": 0, "seconds": 0.0}
+
+
+def schemaCacheKey(definition, formats, use_default, use_formats):
+    payload = json.dumps(
+        [
+            definition,
+            sorted(formats),
+            use_default,
+            use_formats,
+            custom_type_classes,
+            fastjsonschema.VERSION,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def isPrivateDirectory(path):
+    try:
+        status = os.stat(path)
+    except OSError:
+        return False
+    return status.st_uid == os.getuid() and not status.st_mode & 0o022
+
+
+def readCachedValidator(key):
+    if not isPrivateDirectory(schemaCacheDir):
+        return None
+    try:
+        with open(os.path.join(schemaCacheDir, key + ".json")) as file:
+            cached = json.load(file)
+        return (cached["scope"], cached["code"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def writeCachedValidator(key, scope, code):
+    # Write then rename, so that concurrent processes never read a partial
+    # file. The cache is an optimization, failing to write it is not an error
+    try:
+        os.makedirs(schemaCacheDir, mode=0o700, exist_ok=True)
+        if not isPrivateDirectory(schemaCacheDir):
+            return
+        path = os.path.join(schemaCacheDir, key + ".json")
+        temporaryPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporaryPath, "w") as file:
+            json.dump({"scope": scope, "code": code}, file)
+        os.replace(temporaryPath, path)
+    except OSError:
+        pass
+
+
 def customJsonSchemaCompile(
     definition, handlers={}, formats={}, use_default=True, use_formats=True
 ):
@@ -45,20 +116,100 @@ def customJsonSchemaCompile(
     A compile fuction that adds support for custom types like 'objectId'
     To add a checkable type, simply update 'custom_type_classes' and
     'imported_classes' accordingly
+    The generated code can be cached on disk, see schemaCacheDir
     """
-    resolver, code_generator = fastjsonschema._factory(
-        definition, handlers, formats, use_default, use_formats
-    )
-
-    # --------------------------------
-    # Added line
-    code_generator._extra_imports_objects.update(imported_classes)
-    # --------------------------------
-
-    global_state = code_generator.global_state
+    start = time.perf_counter()
+    key = None
+    cached = None
+    if schemaCacheDir and not handlers:
+        key = schemaCacheKey(definition, formats, use_default, use_formats)
+        cached = readCachedValidator(key)
+
+    if cached is None:
+        resolver, code_generator = fastjsonschema._factory(
+            definition, handlers, formats, use_default, use_formats
+        )
+
+        # --------------------------------
+        # Added line
+        code_generator._extra_imports_objects.update(imported_classes)
+        # --------------------------------
+
+        scope = resolver.get_scope_name()
+        # The global state as code (imports and regexes), then the function
+        code = code_generator.global_state_code + code_generator.func_code
+        if key is not None:
+            writeCachedValidator(key, scope, code)
+        schemaCompileStats["generated"] += 1
+    else:
+        scope, code = cached
+        schemaCompileStats["cached"] += 1
+
+    global_state = dict(imported_classes)
     # Do not pass local state so it can recursively call itself.
-    exec(code_generator.func_code, global_state)
-    func = global_state[resolver.get_scope_name()]
+    exec(code, global_state)
+    func = global_state[scope]
+    schemaCompileStats["seconds"] += time.perf_counter() - start
     if formats:
         return update_wrapper(partial(func, custom_formats=formats), func)
     return func
+
+
+# ----------------------------------------------------------------
+# Bulk validation of lists of documents
+# ----------------------------------------------------------------
+
+
+class JsonSchemaListValueException(fastjsonschema.JsonSchemaValueException):
+    """
+    Raised by the list validators, with the errors of all invalid documents
+    in "errors": a list of (index, JsonSchemaValueException)
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        message = "%d invalid documents: %s" % (
+            len(errors),
+            "; ".join(
+                "document %d: %s" % (index, error.message)
+                for index, error in errors
+            ),
+        )
+        first = errors[0][1]
+        super().__init__(
+            message, first.value, first.name, first.definition, first.rule
+        )
+
+
+def customJsonSchemaCompileList(definition, **kwargs):
+    """
+    Compile a validator for lists of documents following the definition.
+    The list is first validated as a whole with a single generated function,
+    without a function call per document. Only when it fails, the documents
+    are validated one by one to report all the invalid documents at once in
+    a JsonSchemaListValueException.
+    Takes the same keyword arguments as customJsonSchemaCompile.
+    """
+    itemDefinition = dict(definition)
+    listDefinition = {"type": "array", "items": itemDefinition}
+    if "$schema" in itemDefinition:
+        listDefinition["$schema"] = itemDefinition.pop("$schema")
+    validateList = customJsonSchemaCompile(listDefinition, **kwargs)
+    validateItem = customJsonSchemaCompile(definition, **kwargs)
+
+    def validate(documents):
+        try:
+            return validateList(documents)
+        except fastjsonschema.JsonSchemaValueException:
+            pass
+        errors = []
+        for index, document in enumerate(documents):
+            try:
+                validateItem(document)
+            except fastjsonschema.JsonSchemaValueException as exp:
+                errors.append((index, exp))
+        if len(errors) > 0:
+            raise JsonSchemaListValueException(errors)
+        return documents
+
+    return validate
@@ -0,0 +1,53 @@
+import queue
+import threading
+
+from girder import logger
+
+
+class HistoryWriter:
+    """
+    Write history entries in a background thread, so that recorded endpoints
+    return as soon as their own writes are done.
+    Entries are written one at a time, in the order they are submitted.
+    Submitting blocks when maxPending entries are waiting to be written.
+    """
+
+    def __init__(self, write, maxPending=256):
+        self.write = write
+        self._queue = queue.Queue(maxsize=maxPending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensureStarted(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="upenn-history-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self.write(*args)
+            except Exception:
+                logger.exception("Failed to write a history entry")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, *args):
+        self._ensureStarted()
+        self._queue.put(args)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the submitted entries are written
+
+        :returns: False if the timeout expired before
+        """
+        condition = self._queue.all_tasks_done
+        with condition:
+            return condition.wait_for(
+                lambda: self._queue.unfinished_tasks == 0, timeout
+            )
@@ -0,0 +1,35 @@
+from girder.exceptions import ValidationException
+
+# MongoDB documents are at most 16 MiB, longer lines can't be stored anyway
+maxLineSize = 16 << 20
+
+
+def readLines(body, blockSize=1 << 20, onRead=None, maxLineSize=maxLineSize):
+    """
+    Read lines from a file-like object by blocks of blockSize bytes.
+
+    :param onRead: Optional callable onRead(bytesRead) called after each block
+    :param maxLineSize: The maximum size of a line in bytes, so that a body
+        without line breaks isn't buffered entirely
+    :raises ValidationException: If a line is longer than maxLineSize
+    """
+    bytesRead = 0
+    remainder = b""
+    while True:
+        block = body.read(blockSize)
+        if not block:
+            break
+        bytesRead += len(block)
+        lines = (remainder + block).split(b"\n")
+        remainder = lines.pop()
+        if len(remainder) > maxLineSize or any(
+            len(line) > maxLineSize for line in lines
+        ):
+            raise ValidationException(
+                "A line is longer than %d bytes" % maxLineSize
+            )
+        yield from lines
+        if onRead is not None:
+            onRead(bytesRead)
+    if remainder:
+        yield remainder
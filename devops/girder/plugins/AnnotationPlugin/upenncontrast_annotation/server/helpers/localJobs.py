@@ -0,0 +1,87 @@
+from girder.models.user import User
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+
+from ..models.annotation import Annotation as AnnotationModel
+from ..models.connections import AnnotationConnection as ConnectionModel
+from ..models.propertyValues import (
+    AnnotationPropertyValues as PropertyValuesModel,
+)
+
+
+def scheduleLocalJob(function, title, user, kwargs):
+    """
+    Schedule a function of this module as a local girder job, run in a thread
+    of the girder process. The function is called with the job document and
+    can find its arguments in job["kwargs"].
+    """
+    job = Job().createLocalJob(
+        module=__name__,
+        function=function,
+        title=title,
+        type="upenncontrast_annotation." + function,
+        user=user,
+        kwargs=kwargs,
+        asynchronous=True,
+    )
+    Job().scheduleJob(job)
+    return job
+
+
+def runLocalJob(job, work):
+    """
+    Run work(progress, **job["kwargs"]) and keep the job status, progress and
+    log up to date. "progress" is a callable progress(current, total, message)
+    and the string returned by work is added to the log.
+    """
+    jobModel = Job()
+    job = jobModel.updateJob(job, log="Started\n", status=JobStatus.RUNNING)
+
+    def progress(current, total, message=None):
+        nonlocal job
+        job = jobModel.updateJob(
+            job,
+            log=None if message is None else message + "\n",
+            progressCurrent=current,
+            progressTotal=total,
+            progressMessage=message,
+        )
+
+    try:
+        result = work(progress, **job["kwargs"])
+    except Exception as exc:
+        jobModel.updateJob(
+            job, log="Failed: {}\n".format(exc), status=JobStatus.ERROR
+        )
+        return
+    jobModel.updateJob(
+        job, log="{}\nDone\n".format(result), status=JobStatus.SUCCESS
+    )
+
+
+def backfillAnnotationGeometry(job):
+    def work(progress, datasetId=None):
+        query = {} if datasetId is None else {"datasetId": datasetId}
+        updated = AnnotationModel().backfillGeometry(query, progress=progress)
+        return "Updated the geometry of {} annotations".format(updated)
+
+    runLocalJob(job, work)
+
+
+def connectToNearest(job):
+    def work(progress, info, userId):
+        user = User().load(userId, force=True)
+        connections = ConnectionModel().connectToNearest(
+            info, user=user, progress=progress
+        )
+        return "Created {} connections".format(len(connections))
+
+    runLocalJob(job, work)
+
+
+def indexPropertyValues(job):
+    def work(progress):
+        indexed = PropertyValuesModel().indexKnownProperties(progress)
+        return "Indexed {} property value paths".format(indexed)
+
+    runLocalJob(job, work)
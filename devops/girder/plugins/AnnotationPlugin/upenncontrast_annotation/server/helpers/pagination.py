@@ -0,0 +1,55 @@
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from girder.api.rest import setResponseHeader
+from girder.constants import SortDir
+from girder.exceptions import RestException
+
+# Keyset pagination: when a page is sorted by _id, the response contains the
+# _id of the last document of the page in this header. Sending it back in the
+# "after" parameter gets the next page without skipping documents.
+continuationTokenHeader = "Girder-Continuation-Token"
+
+keysetSort = [("_id", SortDir.ASCENDING)]
+
+
+def afterToken(query, sort, offset, token):
+    """
+    Restrict a search to the documents following a continuation token.
+
+    :param token: The continuation token, or None to use the offset
+    :returns: The (query, sort, offset) to use for the search
+    """
+    if token is None:
+        return (query, sort, offset)
+    try:
+        lastId = ObjectId(token)
+    except (InvalidId, TypeError):
+        raise RestException("Invalid continuation token", code=400)
+    query = {"$and": [query, {"_id": {"$gt": lastId}}]}
+    return (query, keysetSort, 0)
+
+
+def isKeysetPage(sort, limit, offset):
+    """
+    Whether a page can be followed with a continuation token: it is sorted by
+    _id and starts after a token, or is the first page. Pages requested with
+    an offset keep using offsets.
+    """
+    return sort == keysetSort and limit > 0 and offset == 0
+
+
+def setContinuationToken(sort, limit, offset, page):
+    """
+    Set the continuation token header from the last document of a keyset page
+    when the page is full, meaning that there might be a next page.
+    """
+    if isKeysetPage(sort, limit, offset) and len(page) == limit:
+        setLastIdToken(page[-1]["_id"])
+
+
+def setLastIdToken(lastId):
+    """
+    Set the continuation token header to the id of the last document of a
+    full keyset page, see isKeysetPage
+    """
+    setResponseHeader(continuationTokenHeader, str(lastId))
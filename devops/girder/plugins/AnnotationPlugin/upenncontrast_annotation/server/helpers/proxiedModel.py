@@ -1,10 +1,14 @@
-from girder import events
 from girder.api import rest
 from girder.exceptions import AccessException
+from girder.utility import toBool
 from .customModel import CustomAccessControlledModel
 
+from ..models.documentArchive import DocumentArchive as DocumentArchiveModel
 from ..models.history import History as HistoryModel
 
+import cherrypy
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import wraps
 from bson.objectid import ObjectId
 
@@ -37,16 +41,26 @@ class recordable:
     """
     A decorator which makes a function able to record the write operations on
     the database
+    With optional=True, requests with the recordHistory parameter set to false
+    are not recorded, which is useful for machine-generated bulk writes that
+    no user will undo. The endpoint should document the parameter.
     """
 
-    def __init__(self, actionName, findDatasetIdFn):
+    def __init__(self, actionName, findDatasetIdFn, optional=False):
         self.historyModel: HistoryModel = HistoryModel()
         self.actionName = actionName
         self.findDatasetIdFn = findDatasetIdFn
+        self.optional = optional
 
     def __call__(self, fun):
         @wraps(fun)
         def wrapped_fun(*args, **kwargs):
+            params = cherrypy.request.params
+            if self.optional and not toBool(
+                params.get("recordHistory", "true")
+            ):
+                return fun(*args, **kwargs)
+
             actionDate = HistoryModel.now()
 
             # Find dataset ID
@@ -54,23 +68,27 @@ class recordable:
             if datasetId is None:
                 return fun(*args, **kwargs)
 
-            # Wrap original endpoint between a start and a stop recording
-            events.trigger("proxiedModel.startRecording")
-            val = fun(*args, **kwargs)
-            record = events.trigger("proxiedModel.stopRecording", {}).info
+            # Record the changes made by the original endpoint
+            # The id of the history entry is known while recording, so that
+            # removed documents can be archived directly
+            historyId = ObjectId()
+            with recordChanges(historyId) as recording:
+                val = fun(*args, **kwargs)
+            record = recording.changes()
 
             # Create a new history document
             user = rest.getCurrentUser()
             if user is None:
                 raise AccessException("You must be logged in.")
             document = {
+                "_id": historyId,
                 "actionName": self.actionName,
                 "actionDate": actionDate,
                 "userId": user["_id"],  # type: ignore
                 "isUndone": False,
                 "datasetId": ObjectId(datasetId),
             }
-            self.historyModel.create(user, document, record)
+            self.historyModel.submit(user, document, record)
 
             return val
 
@@ -82,9 +100,13 @@ class ModelRecord:
     A record of changes made to the database
     "changes" associates a string id (not an ObjectId) with a dict:
     { 'before': document or None, 'after': document or None }
+    Changes recorded with changeFields only contain some top-level fields of
+    the documents, listed in 'fields'.
+    Removed documents which are already archived are marked with 'archived'.
     """
 
-    def __init__(self):
+    def __init__(self, historyId=None):
+        self.historyId = historyId
         self.changes = {}
 
     def changeDocument(self, before, after):
@@ -98,63 +120,163 @@ class ModelRecord:
         string_id = str(doc_with_id["_id"])
         old_change = self.changes.get(string_id, None)
         if old_change:
+            fields = old_change.pop("fields", None)
+            if fields is not None and before is not None:
+                # The fields which are not recorded yet are unchanged
+                old_change["before"] = {
+                    **{k: v for k, v in before.items() if k not in fields},
+                    **old_change["before"],
+                }
             # old_change['after'] == before
             old_change["after"] = after
         else:
             self.changes[string_id] = {"before": before, "after": after}
 
+    def changeFields(self, fields, before, after):
+        """
+        Record a change of some top-level fields of a document
+        before and after only contain these fields and the _id
+        """
+        string_id = str(before["_id"])
+        old_change = self.changes.get(string_id, None)
+        if old_change is None:
+            self.changes[string_id] = {
+                "before": before,
+                "after": after,
+                "fields": set(fields),
+            }
+            return
+        if old_change["after"] is None:
+            return
+        old_fields = old_change.get("fields", None)
+        if old_fields is not None:
+            for field in fields - old_fields:
+                if field in before:
+                    old_change["before"][field] = before[field]
+            old_fields.update(fields)
+        old_change["after"] = {
+            **{
+                k: v for k, v in old_change["after"].items() if k not in fields
+            },
+            **after,
+        }
+
+    def removeArchivedDocument(self, documentId):
+        string_id = str(documentId)
+        old_change = self.changes.get(string_id, None)
+        if old_change is None:
+            self.changes[string_id] = {
+                "before": {"_id": documentId},
+                "after": None,
+                "archived": True,
+            }
+            return
+        if old_change.pop("fields", None) is not None:
+            # The archive is completed with the recorded fields
+            old_change["archived"] = True
+        old_change["after"] = None
+
+
+def updatedFields(update):
+    """
+    The top-level fields modified by an update specifier, including the
+    target fields of $rename
+    """
+    fields = set()
+    for operator, values in update.items():
+        fields.update(key.split(".")[0] for key in values)
+        if operator == "$rename":
+            fields.update(value.split(".")[0] for value in values.values())
+    return fields
+
+
+class Recording:
+    """
+    The changes recorded for a history entry, with a ModelRecord for each
+    model which made changes
+    """
+
+    def __init__(self, historyId=None):
+        self.historyId = historyId
+        self.records = {}
+
+    def modelRecord(self, modelName):
+        record = self.records.get(modelName, None)
+        if record is None:
+            record = ModelRecord(self.historyId)
+            self.records[modelName] = record
+        return record
+
+    def changes(self):
+        """
+        The changes of each model: { model_name: ModelRecord.changes }
+        """
+        return {
+            modelName: record.changes
+            for modelName, record in self.records.items()
+        }
+
+
+# The recording of the current request. Each thread (and each asyncio task)
+# has its own value, so concurrent requests record their changes separately
+currentRecording = ContextVar(
+    "upenncontrast_annotation.recording", default=None
+)
+
+
+@contextmanager
+def recordChanges(historyId=None):
+    """
+    Record the changes made by ProxiedAccessControlledModel instances in the
+    current context:
+    ```
+    with recordChanges(historyId) as recording:
+        pass
+    recording.changes()
+    ```
+    """
+    recording = Recording(historyId)
+    token = currentRecording.set(recording)
+    try:
+        yield recording
+    finally:
+        currentRecording.reset(token)
+
 
 class ProxiedAccessControlledModel(CustomAccessControlledModel):
     """
     Enable recording of changes made to the database
     """
 
-    def __init__(self):
-        events.bind(
-            "proxiedModel.startRecording",
-            "upenn.proxiedModel."
-            + self.__class__.__name__
-            + ".startRecording",
-            self.startRecordingEvent,
-        )
-        events.bind(
-            "proxiedModel.stopRecording",
-            "upenn.proxiedModel." + self.__class__.__name__ + ".stopRecording",
-            self.stopRecordingEvent,
-        )
-        super().__init__()
-        self.is_recording = False
-        self.record = ModelRecord()
-
-    def startRecordingEvent(self, event):
-        self.startRecording()
-        # List all the models recording changes
-        if event.info is None:
-            event.info = []
-        event.info.append(self.name)
-
-    def stopRecordingEvent(self, event):
-        record = self.stopRecording()
-        # Map a model name with the changes
-        if event.info is None:
-            event.info = {}
-        event.info[self.name] = record.changes
-
-    def startRecording(self):
-        self.is_recording = True
-        self.record = ModelRecord()
-
-    def stopRecording(self):
-        self.is_recording = False
-        record = self.record
-        self.record = ModelRecord()
-        return record
+    @property
+    def is_recording(self):
+        return currentRecording.get() is not None
+
+    @property
+    def record(self):
+        return currentRecording.get().modelRecord(self.name)
 
     def removeWithQuery(self, query):
         if self.is_recording:
-            docs_before = self.find(query)
-            for before in docs_before:
-                self.record.changeDocument(before, None)
+            # Only read the ids, the documents are archived server-side
+            ids = [
+                document["_id"]
+                for document in self.collection.find(query, {"_id": True})
+            ]
+            archiveModel = DocumentArchiveModel()
+            historyId = self.record.historyId
+            archiveModel.archiveIds(historyId, self.name, self.collection, ids)
+            for id in ids:
+                change = self.record.changes.get(str(id), None)
+                if change is not None and "fields" in change:
+                    archiveModel.restoreFields(
+                        historyId,
+                        self.name,
+                        id,
+                        change["fields"],
+                        change["before"],
+                    )
+                self.record.removeArchivedDocument(id)
         return super().removeWithQuery(query)
 
     def remove(self, document, **kwargs):
@@ -165,13 +287,22 @@ class ProxiedAccessControlledModel(CustomAccessControlledModel):
 
     def update(self, query, update, multi=True):
         if self.is_recording:
-            docs_before = self.find(query)
-            for before in docs_before:
-                self.record.changeDocument(before, None)
+            # Only read the modified fields, before and after the update
+            fields = updatedFields(update)
+            projection = {field: True for field in fields}
+            docs_before = list(self.collection.find(query, projection))
             val = super().update(query, update, multi)
-            docs_after = self.find(query)
-            for after in docs_after:
-                self.record.changeDocument(None, after)
+            ids = [before["_id"] for before in docs_before]
+            docs_after = {
+                after["_id"]: after
+                for after in self.collection.find(
+                    {"_id": {"$in": ids}}, projection
+                )
+            }
+            for before in docs_before:
+                after = docs_after.get(before["_id"], None)
+                if after is not None:
+                    self.record.changeFields(fields, before, after)
             return val
         return super().update(query, update, multi)
 
@@ -185,11 +316,22 @@ class ProxiedAccessControlledModel(CustomAccessControlledModel):
             return after
         return super().save(document, validate, triggerEvents)
 
+    def writeMany(self, documents, triggerEvents=True):
+        if self.is_recording:
+            # Record the documents which will be replaced
+            ids = [
+                ObjectId(document["_id"])
+                for document in documents
+                if "_id" in document
+            ]
+            if len(ids) > 0:
+                for before in self.find({"_id": {"$in": ids}}):
+                    self.record.changeDocument(before, None)
+        return super().writeMany(documents, triggerEvents)
+
     def saveMany(self, documents, validate=True, triggerEvents=True):
         new_documents = super().saveMany(documents, validate, triggerEvents)
         if self.is_recording:
-            # No need to record the removal of existing documents as
-            # saveMany() calls removeWithQuery() which records the removal
             for after in new_documents:
                 self.record.changeDocument(None, after)
         return new_documents
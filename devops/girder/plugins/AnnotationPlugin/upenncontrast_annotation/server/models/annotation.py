@@ -1,15 +1,20 @@
 from ..helpers.tasks import runJobRequest
+from ..helpers.cache import DatasetCache, ExpiringIdCache
 from ..helpers.proxiedModel import ProxiedAccessControlledModel
 from girder.exceptions import ValidationException, RestException
 from girder.constants import AccessType
 from .propertyValues import AnnotationPropertyValues as PropertiesModel
+from ..helpers.connections import boundingBox, computeAnnotationCentroid
 from girder import events
 
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+import json
+import orjson
 
 from girder.models.folder import Folder
 
-from ..helpers.fastjsonschema import customJsonSchemaCompile
+from ..helpers.fastjsonschema import customJsonSchemaCompileList
 import fastjsonschema
 
 
@@ -61,6 +66,9 @@ class AnnotationSchema:
             "color": {
                 "type": ["string", "null"],
             },
+            # Computed when the annotation is validated, see Annotation
+            "centroid": coordSchema,
+            "boundingBox": {"type": "object"},
         },
         # color is optional (legacy, equivalent to null)
         "required": [
@@ -82,10 +90,16 @@ class Annotation(ProxiedAccessControlledModel):
 
     # TODO: write lock
     # TODO: save creatorId, creation and update dates
-    # TODO(performance): indexing
 
-    jsonValidate = staticmethod(
-        customJsonSchemaCompile(AnnotationSchema.annotationSchema)
+    datasetAccessInheritable = True
+
+    # Bounds of the "2d" index on centroids. The index stores 32 bits per axis
+    # so this range gives a precision of 1/128 pixel. Annotations outside of
+    # these bounds are stored without centroid.
+    centroidIndexBounds = (-(2**24), 2**24)
+
+    jsonValidateMultiple = staticmethod(
+        customJsonSchemaCompileList(AnnotationSchema.annotationSchema)
     )
 
     def annotationRemovedEvent(self, event):
@@ -102,8 +116,33 @@ class Annotation(ProxiedAccessControlledModel):
                 "model.upenn_annotation.removeStringIds", annotationStringIds
             )
 
+    def annotationsChangedEvent(self, event):
+        info = event.info or {}
+        documents = info.get("newDocuments", [info])
+        self.countCache.invalidate(
+            set(
+                document["datasetId"]
+                for document in documents
+                if "datasetId" in document
+            )
+        )
+
     def initialize(self):
         self.name = "upenn_annotation"
+        # Estimated number of annotations matching a search query
+        self.countCache = DatasetCache()
+        # Ids of the folders known to be datasets, see invalidDatasetIds
+        self.datasetIdCache = ExpiringIdCache()
+        for event in ["model.folder.save", "model.folder.remove"]:
+            events.bind(
+                event, "upenn.annotations.datasetIdCache", self.folderEvent
+            )
+        for event in ["save.after", "saveMany.after", "remove"]:
+            events.bind(
+                "model.upenn_annotation." + event,
+                "upenn.annotations.countCache",
+                self.annotationsChangedEvent,
+            )
         events.bind(
             "model.folder.remove",
             "upenn.annotations.clean.orphaned",
@@ -121,7 +160,32 @@ class Annotation(ProxiedAccessControlledModel):
             "upenn.connections.multipleAnnotationsRemovedEvent",
             self.multipleAnnotationsRemovedEvent,
         )
-        self.ensureIndices(["datasetId"])
+        self.ensureIndices(
+            [
+                # Search and export endpoints, paginated by _id
+                [[("datasetId", 1), ("_id", 1)], {}],
+                # Search endpoint: filter by shape and tags
+                [[("datasetId", 1), ("shape", 1), ("tags", 1)], {}],
+                # Tile queries: connect to nearest
+                [
+                    [
+                        ("datasetId", 1),
+                        ("location", 1),
+                        ("channel", 1),
+                    ],
+                    {},
+                ],
+                # Index used by findNearestCandidates ($near queries)
+                [
+                    [("centroid", "2d"), ("datasetId", 1)],
+                    {
+                        "min": self.centroidIndexBounds[0],
+                        "max": self.centroidIndexBounds[1],
+                        "bits": 32,
+                    },
+                ],
+            ]
+        )
 
     def cleanOrphaned(self, event):
         if event.info and event.info["_id"]:
@@ -130,18 +194,70 @@ class Annotation(ProxiedAccessControlledModel):
                 "datasetId": folderId,
             }
             self.removeWithQuery(query)
+            self.countCache.invalidate([folderId])
+
+    def folderEvent(self, event):
+        if event.info and "_id" in event.info:
+            self.datasetIdCache.discard([event.info["_id"]])
+
+    def invalidDatasetIds(self, datasetIds):
+        """
+        Find the ids which are not dataset folder ids. The known dataset ids
+        are cached, the other ones are checked with a single query.
+
+        :param datasetIds: An iterable of string ids
+        :returns: The set of invalid ids
+        """
+        invalidIds = set()
+        objectIds = []
+        for datasetId in set(datasetIds):
+            if datasetId in self.datasetIdCache:
+                continue
+            if not ObjectId.is_valid(datasetId):
+                invalidIds.add(datasetId)
+                continue
+            objectIds.append(ObjectId(datasetId))
+        if len(objectIds) == 0:
+            return invalidIds
+        foundIds = set(
+            str(folder["_id"])
+            for folder in Folder().find(
+                {
+                    "_id": {"$in": objectIds},
+                    "meta.subtype": "contrastDataset",
+                },
+                fields=["_id"],
+            )
+        )
+        self.datasetIdCache.add(foundIds)
+        invalidIds.update(
+            str(objectId)
+            for objectId in objectIds
+            if str(objectId) not in foundIds
+        )
+        return invalidIds
 
     def isDatasetId(self, datasetId):
-        folder = Folder().load(datasetId, force=True)
-        return (
-            folder is not None
-            and "meta" in folder
-            and folder["meta"].get("subtype", None) == "contrastDataset"
-        )
+        return len(self.invalidDatasetIds([datasetId])) == 0
 
     def validate(self, document):
         return self.validateMultiple([document])[0]
 
+    def setGeometry(self, annotation):
+        """
+        Store the centroid and the bounding box computed from the coordinates
+        of the annotation, so that they are not computed on each read
+        """
+        annotation["boundingBox"] = boundingBox(annotation["coordinates"])
+        centroid = computeAnnotationCentroid(annotation)
+        minBound, maxBound = self.centroidIndexBounds
+        if minBound <= centroid["x"] < maxBound and (
+            minBound <= centroid["y"] < maxBound
+        ):
+            annotation["centroid"] = centroid
+        else:
+            annotation.pop("centroid", None)
+
     def validateMultiple(self, annotations):
         # Extract property values if they exist
         propertyValues = []
@@ -153,17 +269,18 @@ class Annotation(ProxiedAccessControlledModel):
 
         # Validate using the schema
         try:
-            for annotation in annotations:
-                self.jsonValidate(annotation)
+            self.jsonValidateMultiple(annotations)
         except fastjsonschema.JsonSchemaValueException as exp:
             raise ValidationException(exp)
 
+        # Always recompute the geometry as coordinates may have changed
+        for annotation in annotations:
+            self.setGeometry(annotation)
+
         # Check if the datasets exist
         datasetIds = set(annotation["datasetId"] for annotation in annotations)
-
-        for datasetId in datasetIds:
-            if not self.isDatasetId(datasetId):
-                raise ValidationException("Annotation dataset ID is invalid")
+        if len(self.invalidDatasetIds(datasetIds)) > 0:
+            raise ValidationException("Annotation dataset ID is invalid")
 
         # Add the property values if given
         if len(propertyValues) > 0:
@@ -182,18 +299,61 @@ class Annotation(ProxiedAccessControlledModel):
         return annotations
 
     def create(self, creator, annotation):
-        self.setUserAccess(
-            annotation, user=creator, level=AccessType.ADMIN, save=False
-        )
+        self.checkDatasetWriteAccess([annotation], creator)
+        self.setCreatorAccess(annotation, creator)
         return self.save(annotation)
 
     def createMultiple(self, creator, annotations):
+        self.checkDatasetWriteAccess(annotations, creator)
         for annotation in annotations:
-            self.setUserAccess(
-                annotation, user=creator, level=AccessType.ADMIN, save=False
-            )
+            self.setCreatorAccess(annotation, creator)
         return self.saveMany(annotations)
 
+    def ingest(self, creator, datasetId, lines, chunkSize=5000, progress=None):
+        """
+        Create annotations from JSON lines, validating and inserting them by
+        chunks so that the memory usage doesn't depend on the number of
+        annotations. When a chunk fails, the previous chunks stay created.
+
+        :param datasetId: The dataset of the annotations, used when a line
+            doesn't set it
+        :param lines: An iterable of JSON encoded annotations
+        :param chunkSize: The number of annotations created at once
+        :param progress: Optional callable progress(created)
+        :returns: The number of created annotations
+        """
+        created = 0
+        chunk = []
+        for lineNumber, line in enumerate(lines, 1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                annotation = orjson.loads(line)
+            except orjson.JSONDecodeError as exp:
+                raise ValidationException(
+                    "Invalid annotation on line %d: %s" % (lineNumber, exp)
+                )
+            if not isinstance(annotation, dict):
+                raise ValidationException(
+                    "Invalid annotation on line %d" % lineNumber
+                )
+            annotation.setdefault("datasetId", datasetId)
+            if annotation["datasetId"] != datasetId:
+                raise ValidationException(
+                    "Annotation on line %d is in another dataset" % lineNumber
+                )
+            chunk.append(annotation)
+            if len(chunk) >= chunkSize:
+                created += len(self.createMultiple(creator, chunk))
+                chunk = []
+                if progress is not None:
+                    progress(created)
+        if len(chunk) > 0:
+            created += len(self.createMultiple(creator, chunk))
+            if progress is not None:
+                progress(created)
+        return created
+
     def delete(self, annotation):
         self.remove(annotation)
 
@@ -206,12 +366,97 @@ class Annotation(ProxiedAccessControlledModel):
                 "$in": [ObjectId(stringId) for stringId in annotationStringIds]
             },
         }
+        datasetIds = self.collection.distinct("datasetId", query)
+        self.countCache.invalidate(datasetIds)
         self.removeWithQuery(query)
 
+    def countInDataset(self, query, user, exact=True):
+        """
+        Count the annotations matching a search query on a single dataset.
+        The exact count is cached until the dataset is modified, and used as
+        an estimate when exact is False. The count depends on the access of
+        the user to each annotation, so it is cached per user unless the
+        access is inherited from the dataset.
+
+        :param query: The search query, must contain the datasetId
+        :param exact: Always count the annotations instead of using the cache
+        :returns: The number of annotations
+        """
+        datasetId = query["datasetId"]
+        userId = None
+        if not self.inheritsDatasetAccess():
+            userId = user["_id"] if user else None
+        elif not self.hasDatasetAccess(datasetId, user):
+            return 0
+        key = json.dumps([query, userId], sort_keys=True, default=str)
+        count = None
+        if not exact:
+            count = self.countCache.get(datasetId, key)
+        if count is None:
+            count = self.countWithPermissions(query, user=user)
+            self.countCache.set(datasetId, key, count)
+        return count
+
+    def findNearestCandidates(self, centroid, query, limit=16):
+        """
+        Find the annotations matching the query with the closest centroids,
+        using the "2d" index on centroids.
+        The index only orders annotations using the XY distance, so the
+        result should be refined with the exact distance.
+        Annotations without centroid are not returned.
+
+        :param centroid: The reference coordinates {x, y, z?}
+        :param query: Additional query, should at least contain the datasetId
+        :param limit: The number of candidates to return
+        :returns: A cursor of annotations sorted by XY distance
+        """
+        nearQuery = dict(query)
+        nearQuery["centroid"] = {"$near": [centroid["x"], centroid["y"]]}
+        return self.collection.find(nearQuery, limit=limit)
+
+    def backfillGeometry(self, query=None, chunkSize=5000, progress=None):
+        """
+        Compute the geometry (see setGeometry) of the annotations stored
+        without it, by chunks of annotations.
+
+        :param query: Optional query restricting the annotations to update
+        :param chunkSize: The number of annotations updated at once
+        :param progress: Optional callable progress(current, total)
+        :returns: The number of updated annotations
+        """
+        query = dict(query or {}, boundingBox={"$exists": False})
+        total = self.collection.count_documents(query)
+        updated = 0
+        while True:
+            chunk = list(
+                self.collection.find(
+                    query,
+                    projection={"shape": True, "coordinates": True},
+                    limit=chunkSize,
+                )
+            )
+            if len(chunk) == 0:
+                break
+            requests = []
+            for annotation in chunk:
+                self.setGeometry(annotation)
+                fields = {"boundingBox": annotation["boundingBox"]}
+                if "centroid" in annotation:
+                    fields["centroid"] = annotation["centroid"]
+                requests.append(
+                    UpdateOne({"_id": annotation["_id"]}, {"$set": fields})
+                )
+            self.collection.bulk_write(requests, ordered=False)
+            updated += len(chunk)
+            if progress is not None:
+                progress(updated, total)
+        return updated
+
     def getAnnotationById(self, id, user=None):
         return self.load(id, user=user, level=AccessType.READ)
 
-    def update(self, annotation):
+    def update(self, annotation, user=None):
+        self.checkDatasetWriteAccess([annotation], user)
         return self.save(annotation)
 
     def updateMultiple(self, annotationUpdates, user):
@@ -232,6 +477,7 @@ class Annotation(ProxiedAccessControlledModel):
             updateDoc.pop("id")
             annotation.update(updateDoc)
             updatedAnnotations.append(annotation)
+        self.checkDatasetWriteAccess(updatedAnnotations, user)
         return self.saveMany(updatedAnnotations)
 
     def compute(self, datasetId, tool, user=None):
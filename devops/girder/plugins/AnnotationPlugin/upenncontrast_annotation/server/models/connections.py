@@ -4,13 +4,20 @@ from girder.constants import AccessType
 from girder import events
 
 from bson.objectid import ObjectId
-from girder.models.folder import Folder
 
 from .annotation import Annotation
-from ..helpers.connections import annotationToAnnotationDistance
-
-from ..helpers.fastjsonschema import customJsonSchemaCompile
+from ..helpers.connections import (
+    annotationCentroid,
+    annotationToAnnotationDistance,
+    isAPoint,
+    isAPoly,
+    nearestCentroids,
+    xyDistance,
+)
+
+from ..helpers.fastjsonschema import customJsonSchemaCompileList
 import fastjsonschema
+import math
 import numpy as np
 
 
@@ -37,10 +44,18 @@ class ConnectionSchema:
 
 class AnnotationConnection(ProxiedAccessControlledModel):
     # TODO: write lock
-    # TODO(performance): indexing
 
-    jsonValidate = staticmethod(
-        customJsonSchemaCompile(ConnectionSchema.connectionSchema)
+    datasetAccessInheritable = True
+
+    # Under this number of annotations to connect in a tile, query the
+    # centroid index for each annotation instead of loading the whole tile
+    nearQueryThreshold = 32
+    # Number of candidates of the first centroid index query, see
+    # findNearestCandidate
+    nearCandidates = 16
+
+    jsonValidateMultiple = staticmethod(
+        customJsonSchemaCompileList(ConnectionSchema.connectionSchema)
     )
 
     def annotationsRemovedEvent(self, event):
@@ -74,28 +89,31 @@ class AnnotationConnection(ProxiedAccessControlledModel):
             "upenn.connections.folderRemovedEvent",
             self.folderRemovedEvent,
         )
+        # parentId and childId are used separately in "$or" queries
+        self.ensureIndices(
+            [
+                # Search endpoint, paginated by _id
+                [[("datasetId", 1), ("_id", 1)], {}],
+                "parentId",
+                "childId",
+            ]
+        )
 
     def validate(self, document):
         return self.validateMultiple([document])[0]
 
     def validateMultiple(self, connections):
         try:
-            for connection in connections:
-                self.jsonValidate(connection)
+            self.jsonValidateMultiple(connections)
         except fastjsonschema.JsonSchemaValueException as exp:
             raise ValidationException(exp)
 
-        datasetIds = set(connection["datasetId"] for connection in connections)
-        for datasetId in datasetIds:
-            folder = Folder().load(datasetId, force=True)
-            if folder is None or not (
-                "meta" in folder
-                and folder["meta"].get("subtype", None) == "contrastDataset"
-            ):
-                raise ValidationException("Connection dataset ID is invalid")
-
         annotationModel = Annotation()
 
+        datasetIds = set(connection["datasetId"] for connection in connections)
+        if len(annotationModel.invalidDatasetIds(datasetIds)) > 0:
+            raise ValidationException("Connection dataset ID is invalid")
+
         childIds = set(connection["childId"] for connection in connections)
         childObjectIds = [ObjectId(childId) for childId in childIds]
         nFoundChildren = annotationModel.collection.count_documents(
@@ -115,16 +133,14 @@ class AnnotationConnection(ProxiedAccessControlledModel):
         return connections
 
     def create(self, creator, connection):
-        self.setUserAccess(
-            connection, user=creator, level=AccessType.ADMIN, save=False
-        )
+        self.checkDatasetWriteAccess([connection], creator)
+        self.setCreatorAccess(connection, creator)
         return self.save(connection)
 
     def createMultiple(self, creator, connections):
+        self.checkDatasetWriteAccess(connections, creator)
         for connection in connections:
-            self.setUserAccess(
-                connection, user=creator, level=AccessType.ADMIN, save=False
-            )
+            self.setCreatorAccess(connection, creator)
         return self.saveMany(connections)
 
     def delete(self, connection):
@@ -138,7 +154,8 @@ class AnnotationConnection(ProxiedAccessControlledModel):
         }
         return self.removeWithQuery(query)
 
-    def update(self, connection):
+    def update(self, connection, user=None):
+        self.checkDatasetWriteAccess([connection], user)
         return self.save(connection)
 
     def getClosestAnnotation(self, annotationRef, annotations):
@@ -174,10 +191,9 @@ class AnnotationConnection(ProxiedAccessControlledModel):
             distances[closestAnnotationIdx],
         )
 
-    def connectToNearest(self, info, user=None):
+    def connectToNearest(self, info, user=None, progress=None):
         # annotation ids, a list of tags and a channel index.
-        connections = []
-
+        # progress is an optional callable progress(current, total, message)
         annotationsIdsToConnect = info["annotationsIds"]
         ids = [ObjectId(id) for id in annotationsIdsToConnect]
 
@@ -200,43 +216,200 @@ class AnnotationConnection(ProxiedAccessControlledModel):
         )
         query.update(tagsQuery)
 
-        # Loop on each annotation to connect
-        # Look for the closest annotation and connect to it
-        for id in ids:
-            annotation = Annotation().getAnnotationById(id, user)
+        # Only work on annotations that are placed in the same dataset and in
+        # the same tile: group the annotations to connect by tile
+        tiles = {}
+        datasetIds = {}
+        cursor = Annotation().findWithPermissions(
+            {"_id": {"$in": ids}}, user=user, level=AccessType.READ
+        )
+        for annotation in cursor:
+            datasetId = annotation["datasetId"]
+            location = tuple(annotation["location"].items())
+            tiles.setdefault((datasetId, location), []).append(annotation)
+            datasetIds[annotation["_id"]] = datasetId
+
+        # Look for the closest annotation of each annotation to connect
+        parentIds = {}
+        for tileIndex, ((datasetId, location), annotations) in enumerate(
+            tiles.items()
+        ):
+            if progress is not None:
+                progress(
+                    tileIndex,
+                    len(tiles),
+                    "Connecting {} annotations in tile {}".format(
+                        len(annotations), dict(location)
+                    ),
+                )
+            tileQuery = dict(
+                query, datasetId=datasetId, location=dict(location)
+            )
+            if len(annotations) < self.nearQueryThreshold:
+                parentIds.update(
+                    self.findNearestWithIndex(annotations, tileQuery)
+                )
+            else:
+                parentIds.update(
+                    self.findNearestInTile(annotations, tileQuery)
+                )
 
-            if annotation is None:
-                print("Annotation not defined", id)
-                continue
+        # Define connections, in the order of the given ids
+        connections = [
+            {
+                "tags": [],
+                "label": "A Connection -- automatic",
+                "parentId": parentIds[id],
+                "childId": str(id),
+                "datasetId": datasetIds[id],
+            }
+            for id in dict.fromkeys(ids)
+            if id in parentIds
+        ]
+        if progress is not None:
+            progress(
+                len(tiles),
+                len(tiles),
+                "Saving {} connections".format(len(connections)),
+            )
+        return self.createMultiple(user, connections)
 
-            # Only work on annotations that are placed in the same tile
-            location = annotation["location"]
-            tileQuery = {"location": location}
-            query.update(tileQuery)
+    def findNearestWithIndex(self, annotations, tileQuery):
+        """Find the closest annotation of each annotation using the centroid
+        index. Each annotation costs a few queries but the tile is not loaded.
 
-            # Only work on annotations that are placed in the same dataset
-            datasetId = annotation["datasetId"]
-            datasetQuery = {"datasetId": datasetId}
-            query.update(datasetQuery)
-
-            annotations = list(Annotation().find(query))
-
-            # Find the closest annotation
-            result = self.getClosestAnnotation(annotation, annotations)
-
-            # Define connection
-            if result is not None:
-                connections.append(
-                    self.create(
-                        creator=user,
-                        connection={
-                            "tags": [],
-                            "label": "A Connection -- automatic",
-                            "parentId": str(result[0]["_id"]),
-                            "childId": str(id),
-                            "datasetId": annotation["datasetId"],
-                        },
-                    )
+        Args:
+            annotations (any): the annotations to connect, in the same tile
+            tileQuery (dict): the query matching the candidates of the tile
+
+        Returns:
+            dict: associates the id of an annotation to connect with the
+                string id of its closest annotation
+        """
+        legacyQuery = dict(tileQuery, centroid={"$exists": False})
+        legacyAnnotations = list(Annotation().find(legacyQuery))
+        parentIds = {}
+        for annotation in annotations:
+            closest = self.findNearestCandidate(
+                annotation, tileQuery, legacyAnnotations
+            )
+            if closest is not None:
+                parentIds[annotation["_id"]] = str(closest["_id"])
+        return parentIds
+
+    def findNearestCandidate(self, annotation, tileQuery, legacyAnnotations):
+        """Find the closest annotation of an annotation, with the distance of
+        getClosestAnnotation.
+        The centroid index orders the candidates by XY distance, which is a
+        lower bound of the distance when z is used. The candidates are
+        fetched by growing batches until the XY distance of a candidate is
+        larger than the distance of the closest annotation found.
+
+        Args:
+            annotation (any): the annotation to connect
+            tileQuery (dict): the query matching the candidates of the tile
+            legacyAnnotations (any): the candidates stored without centroid
+
+        Returns:
+            any: the closest annotation, or None if there is no candidate
+        """
+        annotationModel = Annotation()
+        centroid = annotationCentroid(annotation)
+        limit = self.nearCandidates
+        candidates = list(
+            annotationModel.findNearestCandidates(centroid, tileQuery, limit)
+        )
+        if not (isAPoint(annotation) or isAPoly(annotation)):
+            # The distance to any annotation is infinite
+            result = self.getClosestAnnotation(
+                annotation, candidates + legacyAnnotations
+            )
+            return None if result is None else result[0]
+        result = self.getClosestAnnotation(annotation, legacyAnnotations)
+        closest, closestDistance = None, math.inf
+        if result is not None:
+            closest, closestDistance = result
+        seen = 0
+        while True:
+            for candidate in candidates[seen:]:
+                if xyDistance(centroid, candidate["centroid"]) >= (
+                    closestDistance
+                ):
+                    return closest
+                distance = annotationToAnnotationDistance(
+                    annotation, candidate
+                )
+                if closest is None or distance < closestDistance:
+                    closest, closestDistance = candidate, distance
+            if len(candidates) < limit:
+                return closest
+            seen = len(candidates)
+            limit *= 2
+            candidates = list(
+                annotationModel.findNearestCandidates(
+                    centroid, tileQuery, limit
                 )
+            )
 
-        return connections
+    def findNearestInTile(self, annotations, tileQuery):
+        """Find the closest annotation of each annotation by loading the
+        centroids of the tile once and answering all the queries at once,
+        with the distance of getClosestAnnotation.
+
+        Args:
+            annotations (any): the annotations to connect, in the same tile
+            tileQuery (dict): the query matching the candidates of the tile
+
+        Returns:
+            dict: associates the id of an annotation to connect with the
+                string id of its closest annotation
+        """
+        annotationModel = Annotation()
+        candidateIds = []
+        candidateCentroids = []
+        cursor = annotationModel.find(
+            dict(tileQuery, centroid={"$exists": True}),
+            fields={"shape": True, "centroid": True},
+        )
+        for candidate in cursor:
+            if isAPoint(candidate) or isAPoly(candidate):
+                candidateIds.append(candidate["_id"])
+                candidateCentroids.append(candidate["centroid"])
+        # Annotations stored without centroid
+        cursor = annotationModel.find(
+            dict(tileQuery, centroid={"$exists": False}),
+            fields={"shape": True, "coordinates": True},
+        )
+        for candidate in cursor:
+            if isAPoint(candidate) or isAPoly(candidate):
+                candidateIds.append(candidate["_id"])
+                candidateCentroids.append(annotationCentroid(candidate))
+
+        # Other shapes are at an infinite distance of any annotation, so their
+        # closest annotation is found by getClosestAnnotation
+        queries = []
+        others = []
+        for annotation in annotations:
+            if len(candidateIds) > 0 and (
+                isAPoint(annotation) or isAPoly(annotation)
+            ):
+                queries.append(annotation)
+            else:
+                others.append(annotation)
+        parentIds = {}
+        if len(others) > 0:
+            parentIds.update(self.findNearestWithIndex(others, tileQuery))
+        if len(queries) == 0:
+            return parentIds
+
+        indices, _ = nearestCentroids(
+            [annotationCentroid(annotation) for annotation in queries],
+            candidateCentroids,
+        )
+        parentIds.update(
+            {
+                annotation["_id"]: str(candidateIds[index])
+                for annotation, index in zip(queries, indices)
+            }
+        )
+        return parentIds
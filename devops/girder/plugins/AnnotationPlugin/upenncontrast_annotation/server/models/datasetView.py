@@ -64,6 +64,12 @@ class DatasetView(ProxiedAccessControlledModel):
 
     def initialize(self):
         self.name = "dataset_view"
+        self.ensureIndices(
+            [
+                [[("datasetId", 1), ("configurationId", 1)], {}],
+                "configurationId",
+            ]
+        )
 
     def validate(self, document):
         try:
@@ -0,0 +1,172 @@
+from girder.models.model_base import Model
+
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+import datetime
+
+from ..settings import HISTORY_LIFETIME_SECONDS
+
+
+class DocumentArchive(Model):
+    """
+    Copies of the documents removed by a recorded action, used to restore them
+    when the action is undone (or redone for creations).
+    Archived documents are removed with their history entry, or expire after
+    the history entries as they are archived after the action starts.
+    """
+
+    # Number of documents copied by each $merge aggregation
+    archiveChunkSize = 10000
+
+    def initialize(self):
+        self.name = "document_archive"
+        self.ensureIndices(
+            [
+                [
+                    [("historyId", 1), ("modelName", 1), ("documentId", 1)],
+                    {"unique": True},
+                ],
+                [
+                    "archiveDate",
+                    {"expireAfterSeconds": HISTORY_LIFETIME_SECONDS},
+                ],
+            ]
+        )
+
+    def validate(self, document):
+        return document
+
+    @staticmethod
+    def archiveKey(historyId, modelName, documentId):
+        return {
+            "historyId": historyId,
+            "modelName": modelName,
+            "documentId": documentId,
+        }
+
+    def archiveMany(self, historyId, modelName, documents, session=None):
+        requests = []
+        archiveDate = datetime.datetime.now(tz=datetime.timezone.utc)
+        for document in documents:
+            key = self.archiveKey(historyId, modelName, document["_id"])
+            archive = {**key, "archiveDate": archiveDate, "document": document}
+            requests.append(ReplaceOne(key, archive, upsert=True))
+        if len(requests) > 0:
+            self.collection.bulk_write(
+                requests, ordered=False, session=session
+            )
+
+    def archiveIds(self, historyId, modelName, collection, ids, session=None):
+        """
+        Copy documents of another collection to the archive without reading
+        them in this process, using a $merge aggregation.
+        $merge can't be used in a transaction, so the documents are copied
+        through this process when a session is given.
+        """
+        for start in range(0, len(ids), self.archiveChunkSize):
+            query = {"_id": {"$in": ids[start:start + self.archiveChunkSize]}}
+            pipeline = [
+                {"$match": query},
+                {
+                    "$project": {
+                        "_id": False,
+                        "historyId": {"$literal": historyId},
+                        "modelName": {"$literal": modelName},
+                        "documentId": "$_id",
+                        "archiveDate": "$$NOW",
+                        "document": "$$ROOT",
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": self.name,
+                        "on": ["historyId", "modelName", "documentId"],
+                        "whenMatched": "replace",
+                        "whenNotMatched": "insert",
+                    }
+                },
+            ]
+            if session is None and self.aggregateMerge(collection, pipeline):
+                continue
+            self.archiveMany(
+                historyId,
+                modelName,
+                collection.find(query, session=session),
+                session,
+            )
+
+    def restoreIds(self, historyId, modelName, collection, ids, session=None):
+        """
+        Restore archived documents in their collection, using a $merge
+        aggregation when no session is given
+        """
+        for start in range(0, len(ids), self.archiveChunkSize):
+            query = {
+                **self.archiveKey(historyId, modelName, None),
+                "documentId": {
+                    "$in": ids[start:start + self.archiveChunkSize]
+                },
+            }
+            pipeline = [
+                {"$match": query},
+                {"$replaceRoot": {"newRoot": "$document"}},
+                {
+                    "$merge": {
+                        "into": collection.name,
+                        "on": "_id",
+                        "whenMatched": "replace",
+                        "whenNotMatched": "insert",
+                    }
+                },
+            ]
+            if session is None and self.aggregateMerge(
+                self.collection, pipeline
+            ):
+                continue
+            requests = [
+                ReplaceOne(
+                    {"_id": entry["document"]["_id"]},
+                    entry["document"],
+                    upsert=True,
+                )
+                for entry in self.collection.find(query, session=session)
+            ]
+            if len(requests) > 0:
+                collection.bulk_write(requests, ordered=False, session=session)
+
+    @staticmethod
+    def aggregateMerge(collection, pipeline):
+        """
+        Run an aggregation ending with a $merge stage
+
+        :returns: False if $merge is not supported
+        """
+        try:
+            collection.aggregate(pipeline)
+        except (OperationFailure, NotImplementedError):
+            # $merge needs MongoDB 4.2 and is not supported by mongomock
+            return False
+        return True
+
+    def restoreFields(self, historyId, modelName, documentId, fields, values):
+        """
+        Set top-level fields of an archived document to their values, and
+        unset the fields which are missing from values
+        """
+        update = {}
+        setFields = {
+            "document." + field: values[field]
+            for field in fields
+            if field in values
+        }
+        if len(setFields) > 0:
+            update["$set"] = setFields
+        unsetFields = {
+            "document." + field: "" for field in fields if field not in values
+        }
+        if len(unsetFields) > 0:
+            update["$unset"] = unsetFields
+        if len(update) > 0:
+            self.collection.update_one(
+                self.archiveKey(historyId, modelName, documentId), update
+            )
@@ -1,11 +1,14 @@
 from girder.constants import AccessType
 from girder.exceptions import ValidationException
 
+from .documentArchive import DocumentArchive as DocumentArchiveModel
 from ..helpers.customModel import CustomAccessControlledModel
 from ..helpers.fastjsonschema import customJsonSchemaCompile
+from ..settings import HISTORY_LIFETIME_SECONDS
 import fastjsonschema
 
 from bson.objectid import ObjectId
+from pymongo import DeleteMany, DeleteOne, ReplaceOne, UpdateOne
 
 
 class DocumentChangeSchema:
@@ -24,16 +27,27 @@ class DocumentChangeSchema:
             "documentId": {
                 "type": "objectId",
             },
-            # Document before action, can be None
+            # Date of the history entry, for the TTL index
+            "actionDate": {
+                "type": "datetime",
+            },
+            # See DocumentChange.compactChange
+            "kind": {
+                "type": "string",
+                "enum": ["create", "update", "delete"],
+            },
+            # Changed fields before the action (full document before the
+            # action for changes without kind), can be None
             "before": {
                 "type": ["object", "null"],
             },
-            # Document after action, can be None
+            # Changed fields after the action (full document after the action
+            # for changes without kind), can be None
             "after": {
                 "type": ["object", "null"],
             },
         },
-        "required": ["historyId", "modelName", "before", "after"],
+        "required": ["historyId", "modelName", "documentId"],
     }
 
 
@@ -49,6 +63,19 @@ class DocumentChange(CustomAccessControlledModel):
 
     def initialize(self):
         self.name = "document_change"
+        self.documentArchiveModel: DocumentArchiveModel = (
+            DocumentArchiveModel()
+        )
+        self.ensureIndices(
+            [
+                [[("historyId", 1), ("modelName", 1)], {}],
+                # Expiration with the history entries
+                [
+                    "actionDate",
+                    {"expireAfterSeconds": HISTORY_LIFETIME_SECONDS},
+                ],
+            ]
+        )
 
     def validate(self, document):
         try:
@@ -58,22 +85,123 @@ class DocumentChange(CustomAccessControlledModel):
             raise ValidationException(exp)
         return document
 
-    def createChangesFromRecord(self, history_id, record, creator):
+    @staticmethod
+    def compactChange(before, after):
+        """
+        Get the compact representation of a change:
+        - a creation only references the created document
+        - an update stores the top-level fields which changed, before and
+          after the update
+        - a deletion only references the removed document, which is archived
+
+        :returns: The kind and the fields of the change, or None if the
+            document didn't change
+        """
+        if before is None and after is None:
+            return None
+        if before is None:
+            return {"kind": "create"}
+        if after is None:
+            return {"kind": "delete"}
+        missing = object()
+        keys = [
+            key
+            for key in before.keys() | after.keys()
+            if before.get(key, missing) != after.get(key, missing)
+        ]
+        if len(keys) == 0:
+            return None
+        return {
+            "kind": "update",
+            "before": {key: before[key] for key in keys if key in before},
+            "after": {key: after[key] for key in keys if key in after},
+        }
+
+    def createChangesFromRecord(
+        self, history_id, action_date, record, creator
+    ):
         # The record is a dict:
         # { model_name: { document_id: { before: ..., after: ... } } }
         document_changes = []
         for model_name in record:
+            removed_documents = []
             for document_id in record[model_name]:
                 raw_change = record[model_name][document_id]
+                change = self.compactChange(
+                    raw_change["before"], raw_change["after"]
+                )
+                if change is None:
+                    continue
+                if change["kind"] == "delete" and not raw_change.get(
+                    "archived", False
+                ):
+                    removed_documents.append(raw_change["before"])
                 new_document_change = {
                     "historyId": history_id,
+                    "actionDate": action_date,
                     "modelName": model_name,
                     "documentId": ObjectId(document_id),
-                    "before": raw_change["before"],
-                    "after": raw_change["after"],
+                    **change,
                 }
                 self.setUserAccess(
                     new_document_change, user=creator, level=AccessType.ADMIN
                 )
                 document_changes.append(new_document_change)
+            self.documentArchiveModel.archiveMany(
+                history_id, model_name, removed_documents
+            )
         self.saveMany(document_changes)
+
+    def applyChanges(
+        self, historyId, modelName, collection, changes, undo, session=None
+    ):
+        """
+        Undo or redo document changes of a model with bulk writes
+        """
+        requests = []
+        removed_ids = []
+        restored_ids = []
+        for change in changes:
+            document_id = change["documentId"]
+            kind = change.get("kind")
+            if kind is None:
+                # Full documents, recorded before the compact representation
+                replacement = change["before" if undo else "after"]
+                if replacement is None:
+                    requests.append(DeleteOne({"_id": document_id}))
+                else:
+                    requests.append(
+                        ReplaceOne(
+                            {"_id": document_id}, replacement, upsert=True
+                        )
+                    )
+            elif kind == "update":
+                fields = change["before" if undo else "after"]
+                other_fields = change["after" if undo else "before"]
+                update = {}
+                if len(fields) > 0:
+                    update["$set"] = fields
+                unset = {key: "" for key in other_fields if key not in fields}
+                if len(unset) > 0:
+                    update["$unset"] = unset
+                requests.append(UpdateOne({"_id": document_id}, update))
+            elif (kind == "create") == undo:
+                # Undo a creation or redo a deletion: remove the document and
+                # keep a copy to restore it later
+                removed_ids.append(document_id)
+            else:
+                # Undo a deletion or redo a creation: restore the archived copy
+                restored_ids.append(document_id)
+
+        archive = self.documentArchiveModel
+        if len(removed_ids) > 0:
+            archive.archiveIds(
+                historyId, modelName, collection, removed_ids, session
+            )
+            requests.append(DeleteMany({"_id": {"$in": removed_ids}}))
+        if len(requests) > 0:
+            collection.bulk_write(requests, ordered=False, session=session)
+        if len(restored_ids) > 0:
+            archive.restoreIds(
+                historyId, modelName, collection, restored_ids, session
+            )
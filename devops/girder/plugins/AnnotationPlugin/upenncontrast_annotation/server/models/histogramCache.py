@@ -0,0 +1,79 @@
+from girder.models.model_base import Model
+
+
+class HistogramCache(Model):
+    """
+    Cache of the property values histograms, indexed by dataset, property path
+    and number of buckets.
+    Each dataset has a generation which is incremented when the cached
+    histograms of the dataset are invalidated. A histogram computed during an
+    invalidation is not cached, as it may be outdated.
+    """
+
+    def initialize(self):
+        self.name = "annotation_property_histogram"
+        self.ensureIndices(
+            [
+                [
+                    [("datasetId", 1), ("propertyPath", 1), ("buckets", 1)],
+                    {"unique": True},
+                ],
+            ]
+        )
+
+    def validate(self, document):
+        return document
+
+    def getGeneration(self, datasetId):
+        entry = self.collection.find_one(
+            {"datasetId": datasetId, "propertyPath": None}
+        )
+        return 0 if entry is None else entry["generation"]
+
+    def get(self, datasetId, propertyPath, buckets):
+        """
+        Get a cached histogram and the current generation of the dataset
+
+        :returns: A tuple (histogram or None, generation)
+        """
+        generation = self.getGeneration(datasetId)
+        entry = self.collection.find_one(
+            {
+                "datasetId": datasetId,
+                "propertyPath": propertyPath,
+                "buckets": buckets,
+                "generation": generation,
+            }
+        )
+        return (None if entry is None else entry["histogram"], generation)
+
+    def set(self, datasetId, propertyPath, buckets, histogram, generation):
+        """
+        Cache a histogram computed during the given generation of the dataset
+        """
+        if self.getGeneration(datasetId) != generation:
+            return
+        query = {
+            "datasetId": datasetId,
+            "propertyPath": propertyPath,
+            "buckets": buckets,
+        }
+        self.collection.replace_one(
+            query,
+            dict(query, generation=generation, histogram=histogram),
+            upsert=True,
+        )
+
+    def invalidate(self, datasetIds):
+        """
+        Remove the cached histograms of the datasets
+        """
+        for datasetId in set(datasetIds):
+            self.collection.update_one(
+                {"datasetId": datasetId, "propertyPath": None},
+                {"$inc": {"generation": 1}, "$set": {"buckets": None}},
+                upsert=True,
+            )
+            self.collection.delete_many(
+                {"datasetId": datasetId, "propertyPath": {"$ne": None}}
+            )
@@ -1,15 +1,23 @@
 from girder.constants import SortDir, AccessType
 from girder.exceptions import ValidationException
+from girder.models import getDbConnection
+from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
 
 from .documentChange import DocumentChange as DocumentChangeModel
+from .histogramCache import HistogramCache as HistogramCacheModel
 from ..helpers.customModel import CustomAccessControlledModel
+from ..helpers.export import chunked
+from ..helpers.historyWriter import HistoryWriter
+from ..settings import HISTORY_LIFETIME_SECONDS, PluginSettings
 
 from ..helpers.fastjsonschema import customJsonSchemaCompile
 import fastjsonschema
 
 from bson.objectid import ObjectId
 import datetime
+import itertools
+import time
 
 
 class HistorySchema:
@@ -52,6 +60,18 @@ class History(CustomAccessControlledModel):
         customJsonSchemaCompile(HistorySchema.historySchema)
     )
 
+    # Number of document changes applied by each bulk write when undoing or
+    # redoing an action
+    undoChunkSize = 5000
+
+    # Actions with more document changes are undone and redone without a
+    # transaction, which would exceed the transaction lifetime limit of
+    # MongoDB (60 seconds by default)
+    transactionMaxChanges = 10000
+
+    # Entries beyond this number are removed by sweep
+    maxEntriesPerUser = 10
+
     @staticmethod
     def now():
         return datetime.datetime.now(tz=datetime.timezone.utc)
@@ -59,6 +79,46 @@ class History(CustomAccessControlledModel):
     def initialize(self):
         self.name = "history"
         self.documentChangeModel: DocumentChangeModel = DocumentChangeModel()
+        # See submit
+        self.writer = HistoryWriter(self.create)
+        self.ensureIndices(
+            [
+                # getLastEntries and undoOrRedo
+                [
+                    [
+                        ("userId", 1),
+                        ("datasetId", 1),
+                        ("isUndone", 1),
+                        ("actionDate", -1),
+                    ],
+                    {},
+                ],
+                # Expiration of old entries
+                [
+                    "actionDate",
+                    {"expireAfterSeconds": HISTORY_LIFETIME_SECONDS},
+                ],
+                # Cap of entries per user
+                [[("userId", 1), ("actionDate", -1)], {}],
+                # Cleanup of undone entries, which are few
+                [
+                    [("userId", 1)],
+                    {
+                        "name": "userId_undone",
+                        "partialFilterExpression": {"isUndone": True},
+                    },
+                ],
+            ]
+        )
+
+    def reconnect(self):
+        # actionDate used to be indexed without expiration, which conflicts
+        # with the TTL index
+        collection = getDbConnection().get_database()[self.name]
+        index = collection.index_information().get("actionDate_1")
+        if index is not None and "expireAfterSeconds" not in index:
+            collection.drop_index("actionDate_1")
+        super().reconnect()
 
     def validate(self, document):
         try:
@@ -74,20 +134,59 @@ class History(CustomAccessControlledModel):
         Only return some fields from the model, as the record can be heavy and
         the userId is useless
         """
+        self.writer.flush()
         query = {"userId": user["_id"], "datasetId": datasetId}
         sort = [("actionDate", SortDir.DESCENDING)]
         fields = {"_id": 0, "actionName": 1, "actionDate": 1, "isUndone": 1}
+        # Entries beyond the cap may remain until the next sweep
         return self.findWithPermissions(
-            query, sort=sort, fields=fields, user=user
+            query,
+            sort=sort,
+            fields=fields,
+            limit=self.maxEntriesPerUser,
+            user=user,
         )
 
     def undo(self, user, datasetId):
-        self.undoOrRedo(user, datasetId, True)
+        return self.undoOrRedo(user, datasetId, True)
 
     def redo(self, user, datasetId):
-        self.undoOrRedo(user, datasetId, False)
+        return self.undoOrRedo(user, datasetId, False)
+
+    def supportsTransactions(self):
+        # Transactions need a replica set or a sharded cluster
+        description = self.database.client.topology_description
+        return getattr(description, "topology_type_name", None) in (
+            "ReplicaSetWithPrimary",
+            "Sharded",
+        )
+
+    def useTransaction(self, historyId):
+        """
+        Whether to undo or redo an action in a transaction: the database must
+        support it and the action must have at most transactionMaxChanges
+        document changes
+        """
+        if not self.supportsTransactions():
+            return False
+        count = self.documentChangeModel.collection.count_documents(
+            {"historyId": historyId}, limit=self.transactionMaxChanges + 1
+        )
+        return count <= self.transactionMaxChanges
 
     def undoOrRedo(self, user, datasetId, undo: bool):
+        """
+        Undo or redo the last action of the user in the dataset.
+        The document changes are applied with unordered bulk writes grouped
+        by model, in a transaction when the database supports it and the
+        action is small enough, see useTransaction.
+
+        :returns: A summary of the undone or redone action and its timing, or
+            None if there is no action to undo or redo
+        """
+        start = time.perf_counter()
+        # Entries written in the background must exist before undoing
+        self.writer.flush()
         # Get the most recent action which has (not) been undone
         query = {
             "userId": user["_id"],
@@ -104,90 +203,140 @@ class History(CustomAccessControlledModel):
             None,
         )
         if history_entry is None:
-            return
+            return None
 
-        # Find the document changes for this history entry
-        # Would have to use an aggregation pipeline to group by model_name
-        # This feature is not available in girder, use the sort instead
-        document_changes = self.documentChangeModel.findWithPermissions(
-            {"historyId": history_entry["_id"]},
-            sort=[("model_name", SortDir.ASCENDING)],
-            user=user,
-            level=AccessType.READ,
-        )
-
-        # Undo or redo the action
-        change_key = "before" if undo else "after"
-        previous_model_name = ""
-        model = None
-        for change in document_changes:
-            document_id = change["documentId"]
-            model_name = change["modelName"]
-            if model_name != previous_model_name:
+        def applyChanges(session=None):
+            # Find the document changes for this history entry, grouped by
+            # model using the sort
+            documentChangeModel = self.documentChangeModel
+            document_changes = documentChangeModel.collection.find(
+                documentChangeModel.accessQuery(
+                    {"historyId": history_entry["_id"]}, user, AccessType.READ
+                ),
+                sort=[("modelName", SortDir.ASCENDING)],
+                session=session,
+            )
+            count = 0
+            for model_name, changes in itertools.groupby(
+                document_changes, key=lambda change: change["modelName"]
+            ):
                 model: CustomAccessControlledModel = ModelImporter.model(
                     model_name, "upenncontrast_annotation"
                 )
-                previous_model_name = model_name
-            # Use 'before' when undoing, and 'after' when redoing
-            replacement = change[change_key]
-            if replacement is None:
-                model.collection.delete_one({"_id": document_id})
-            else:
-                model.collection.replace_one(
-                    {"_id": document_id}, replacement, upsert=True
-                )
+                # Cached counts of the dataset are outdated
+                if getattr(model, "countCache", None) is not None:
+                    model.countCache.invalidate([datasetId])
+                for chunk in chunked(changes, self.undoChunkSize):
+                    self.documentChangeModel.applyChanges(
+                        history_entry["_id"],
+                        model_name,
+                        model.collection,
+                        chunk,
+                        undo,
+                        session,
+                    )
+                    count += len(chunk)
+            # Update the entry
+            self.collection.update_one(
+                {"_id": history_entry["_id"]},
+                {"$set": {"isUndone": undo}},
+                session=session,
+            )
+            return count
 
-        # Update the entry
-        history_entry["isUndone"] = undo
-        return self.save(history_entry)
-
-    def cleanRemoveWithQuery(self, query, creator, **kwargs):
-        # Find the ids of the docs to remove
-        removed_docs = self.find(
-            query=query,
-            user=creator,
-            level=AccessType.WRITE,
-            fields={"_id": 1},
-            **kwargs
-        )
-        removed_ids = [entry["_id"] for entry in removed_docs]
-        if len(removed_ids) == 0:
+        transaction = self.useTransaction(history_entry["_id"])
+        if transaction:
+            with self.database.client.start_session() as session:
+                count = session.with_transaction(applyChanges)
+        else:
+            count = applyChanges()
+
+        # The collections are modified without triggering events
+        if count > 0:
+            HistogramCacheModel().invalidate([str(datasetId)])
+
+        return {
+            "_id": history_entry["_id"],
+            "actionName": history_entry["actionName"],
+            "actionDate": history_entry["actionDate"],
+            "isUndone": undo,
+            "changes": count,
+            "transaction": transaction,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def removeEntries(self, ids):
+        """
+        Remove history entries with their document changes and archived
+        documents
+        """
+        if len(ids) == 0:
             return
-        # Remove the docs
-        self.removeWithQuery({"_id": {"$in": removed_ids}})
-        # Cleanup the document changes
-        self.documentChangeModel.removeWithQuery(
-            {"historyId": {"$in": removed_ids}}
-        )
+        query = {"historyId": {"$in": ids}}
+        self.removeWithQuery({"_id": {"$in": ids}})
+        self.documentChangeModel.removeWithQuery(query)
+        self.documentChangeModel.documentArchiveModel.removeWithQuery(query)
 
-    def create(self, creator, entry, record):
-        # Remove history entries older than 1 hour or that have been undone
-        min_entry_date = History.now() - datetime.timedelta(hours=1)
-        self.cleanRemoveWithQuery(
-            {
-                "$or": [
-                    {"actionDate": {"$lt": min_entry_date}},
-                    {"userId": creator["_id"], "isUndone": True},
-                ]
-            },
-            creator,
+    def sweep(self):
+        """
+        Remove the entries beyond the cap of entries per user, and the
+        document changes left by expired entries which were recorded before
+        document changes had an actionDate.
+        Entries older than HISTORY_LIFETIME_SECONDS are removed by the TTL
+        indexes.
+        """
+        pipeline = [
+            {"$group": {"_id": "$userId", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": self.maxEntriesPerUser}}},
+        ]
+        for group in list(self.collection.aggregate(pipeline)):
+            entries = self.collection.find(
+                {"userId": group["_id"]},
+                {"_id": True},
+                sort=[("actionDate", SortDir.DESCENDING)],
+                skip=self.maxEntriesPerUser,
+            )
+            self.removeEntries([entry["_id"] for entry in entries])
+
+        legacyIds = self.documentChangeModel.collection.distinct(
+            "historyId", {"actionDate": {"$exists": False}}
         )
+        if len(legacyIds) > 0:
+            existingIds = set(
+                self.collection.distinct("_id", {"_id": {"$in": legacyIds}})
+            )
+            self.removeEntries(
+                [id for id in legacyIds if id not in existingIds]
+            )
 
-        # Cap the number of entries per user
-        max_entries_per_user = 10
-        self.cleanRemoveWithQuery(
-            {"userId": creator["_id"]},
-            creator,
-            sort=[("actionDate", SortDir.DESCENDING)],
-            offset=max_entries_per_user - 1,
+    def create(self, creator, entry, record):
+        # Entries undone by the user can't be redone after a new action
+        # The partial index makes this a cheap lookup when there are none
+        undone = self.collection.find(
+            {"userId": creator["_id"], "isUndone": True}, {"_id": True}
         )
+        self.removeEntries([undoneEntry["_id"] for undoneEntry in undone])
 
         self.setUserAccess(
             entry, user=creator, level=AccessType.ADMIN, save=False
         )
         new_history_entry = self.save(entry)
         self.documentChangeModel.createChangesFromRecord(
-            new_history_entry["_id"], record, creator
+            new_history_entry["_id"],
+            new_history_entry["actionDate"],
+            record,
+            creator,
         )
 
         return new_history_entry
+
+    def submit(self, creator, entry, record):
+        """
+        Create the history entry, in a background thread when asynchronous
+        history is enabled. Undo, redo and getLastEntries wait for the
+        entries written in the background.
+        """
+        if Setting().get(PluginSettings.ASYNCHRONOUS_HISTORY):
+            self.writer.submit(creator, entry, record)
+            return entry
+        return self.create(creator, entry, record)
@@ -1,10 +1,14 @@
 from ..helpers.proxiedModel import ProxiedAccessControlledModel
-from girder.constants import AccessType
 from girder.exceptions import ValidationException
-from girder import events
+from girder import events, logger
 
-from ..helpers.fastjsonschema import customJsonSchemaCompile
+from .histogramCache import HistogramCache as HistogramCacheModel
+from .property import AnnotationProperty as PropertyModel
+
+from ..helpers.fastjsonschema import customJsonSchemaCompileList
 import fastjsonschema
+import threading
+from collections import Counter
 
 
 class PropertySchema:
@@ -41,18 +45,70 @@ class PropertySchema:
     }
 
 
+def valuePaths(values, prefix=""):
+    """
+    List the paths of the leaf values of a (nested) dict of property values,
+    e.g. {"a": 1, "b": {"c": 2}} gives ["a", "b.c"]
+    """
+    paths = []
+    for key, value in values.items():
+        if isinstance(value, dict):
+            paths.extend(valuePaths(value, prefix + key + "."))
+        else:
+            paths.append(prefix + key)
+    return paths
+
+
 class AnnotationPropertyValues(ProxiedAccessControlledModel):
 
-    jsonValidate = staticmethod(
-        customJsonSchemaCompile(PropertySchema.annotationPropertySchema)
+    datasetAccessInheritable = True
+
+    # MongoDB allows 64 indexes per collection, keep room for the others.
+    # The most used property paths get an index, see indexKnownProperties
+    maxValueIndices = 48
+    # Wildcard index on all the values, replaced by the partial indexes
+    legacyWildcardIndex = "values.$**_1"
+
+    jsonValidateMultiple = staticmethod(
+        customJsonSchemaCompileList(PropertySchema.annotationPropertySchema)
     )
 
     def annotationsRemovedEvent(self, event):
         # Clean property values orphaned by the deletion of the annotations
         annotationStringIds = event.info
         query = {"annotationId": {"$in": annotationStringIds}}
+        self.histogramCacheModel.invalidate(
+            self.collection.distinct("datasetId", query)
+        )
         self.removeWithQuery(query)
 
+    def valuesChangedEvent(self, event):
+        # Invalidate the histograms of the datasets of the changed documents
+        if event.name.endswith("saveMany.after"):
+            documents = event.info["newDocuments"]
+        else:
+            documents = [event.info]
+        self.histogramCacheModel.invalidate(
+            document["datasetId"]
+            for document in documents
+            if "datasetId" in document
+        )
+
+    def propertyRemovedEvent(self, event):
+        # Drop the indexes of the values of the removed property
+        propertyId = str(event.info["_id"])
+        self.dropValueIndices(
+            [
+                path
+                for path in self.indexedValuePaths()
+                if path == propertyId or path.startswith(propertyId + ".")
+            ]
+        )
+
+    def folderRemovedEvent(self, event):
+        if event.info and event.info["_id"]:
+            self.histogramCacheModel.invalidate([str(event.info["_id"])])
+
     def initialize(self):
         self.name = "annotation_property_values"
         events.bind(
@@ -60,14 +116,154 @@ class AnnotationPropertyValues(ProxiedAccessControlledModel):
             "upenn.annotation_values.annotationsRemovedEvent",
             self.annotationsRemovedEvent,
         )
+        self.histogramCacheModel: HistogramCacheModel = HistogramCacheModel()
+        for eventName in ["saveMany.after", "save.after", "remove"]:
+            events.bind(
+                "model.annotation_property_values." + eventName,
+                "upenn.annotation_values.histogramCache",
+                self.valuesChangedEvent,
+            )
+        events.bind(
+            "model.annotation_property.remove",
+            "upenn.annotation_values.propertyRemovedEvent",
+            self.propertyRemovedEvent,
+        )
+        events.bind(
+            "model.folder.remove",
+            "upenn.annotation_values.folderRemovedEvent",
+            self.folderRemovedEvent,
+        )
+        self.ensureIndices(
+            [
+                "annotationId",
+                [[("datasetId", 1), ("annotationId", 1)], {}],
+                # Search endpoint, paginated by _id
+                [[("datasetId", 1), ("_id", 1)], {}],
+            ]
+        )
+        # Property paths with a dedicated index, see ensureValueIndices
+        self._indexedValuePaths = None
+        self._indexedValuePathsLock = threading.Lock()
+        # Number of histogram requests of each property path since startup
+        self._valuePathUses = Counter()
+
+    def reconnect(self):
+        self._indexedValuePaths = None
+        super().reconnect()
+        if self.legacyWildcardIndex in self.collection.index_information():
+            self.collection.drop_index(self.legacyWildcardIndex)
+
+    def _loadIndexedValuePaths(self):
+        # Must be called with _indexedValuePathsLock
+        if self._indexedValuePaths is None:
+            self._indexedValuePaths = {}
+            for name, index in self.collection.index_information().items():
+                keys = [key for key, _ in index["key"]]
+                if (
+                    len(keys) == 2
+                    and keys[0] == "datasetId"
+                    and keys[1].startswith("values.")
+                    and "partialFilterExpression" in index
+                ):
+                    path = keys[1][len("values."):]
+                    self._indexedValuePaths[path] = name
+        return self._indexedValuePaths
+
+    def indexedValuePaths(self):
+        """
+        The set of property paths which have an index
+        """
+        with self._indexedValuePathsLock:
+            return set(self._loadIndexedValuePaths())
+
+    def ensureValueIndices(self, paths):
+        """
+        Create a partial index on (datasetId, values.<path>) for each property
+        path, so that histograms only scan the documents which have a value
+        for this path. Index builds can be slow, so this is only called by
+        indexKnownProperties and never when serving a request.
+        Once maxValueIndices paths are indexed, the other paths are skipped
+        with a warning.
+
+        :returns: The number of paths which have an index
+        """
+        with self._indexedValuePathsLock:
+            indexed = self._loadIndexedValuePaths()
+            skipped = []
+            for path in paths:
+                if path in indexed:
+                    continue
+                if len(indexed) >= self.maxValueIndices:
+                    skipped.append(path)
+                    continue
+                valueKey = "values." + path
+                indexed[path] = self.collection.create_index(
+                    [("datasetId", 1), (valueKey, 1)],
+                    partialFilterExpression={valueKey: {"$exists": True}},
+                )
+            if len(skipped) > 0:
+                logger.warning(
+                    "Property value index limit (%d) reached, not indexing: %s"
+                    % (self.maxValueIndices, ", ".join(skipped))
+                )
+            return len(set(paths) & set(indexed))
+
+    def dropValueIndices(self, paths):
+        """
+        Drop the indexes of some property paths, see ensureValueIndices
+        """
+        with self._indexedValuePathsLock:
+            indexed = self._loadIndexedValuePaths()
+            for path in paths:
+                name = indexed.pop(path, None)
+                if name is not None:
+                    self.collection.drop_index(name)
+
+    def knownValuePaths(self):
+        """
+        List the value paths of the known properties, using a stored value of
+        each property to find its sub-paths. The values of unknown property
+        ids are not indexed.
+        """
+        paths = []
+        for property in PropertyModel().find({}, fields=["_id"]):
+            propertyId = str(property["_id"])
+            valueKey = "values." + propertyId
+            sample = self.collection.find_one(
+                {valueKey: {"$exists": True}}, projection={valueKey: True}
+            )
+            if sample is not None:
+                paths.extend(valuePaths(sample["values"]))
+        return paths
+
+    def indexKnownProperties(self, progress=None):
+        """
+        Index the value paths of the known properties, see ensureValueIndices
+        The paths with the most histogram requests come first when there are
+        more than maxValueIndices paths. The indexes of the other paths, and
+        of the paths of removed properties, are dropped.
+
+        :param progress: Optional callable progress(current, total, message)
+        :returns: The number of indexed paths
+        """
+        paths = self.knownValuePaths()
+        # Stable sort: paths which were never requested keep their order
+        paths.sort(key=lambda path: -self._valuePathUses[path])
+        kept = set(paths[:self.maxValueIndices])
+        self.dropValueIndices(
+            [path for path in self.indexedValuePaths() if path not in kept]
+        )
+        indexed = self.ensureValueIndices(paths)
+        if progress is not None:
+            progress(len(paths), len(paths), "Indexed %d paths" % indexed)
+        return indexed
 
     def validate(self, document):
         return self.validateMultiple([document])[0]
 
     def validateMultiple(self, propertyValuesList):
         try:
-            for propertyValues in propertyValuesList:
-                self.jsonValidate(propertyValues)
+            self.jsonValidateMultiple(propertyValuesList)
         except fastjsonschema.JsonSchemaValueException as exp:
             raise ValidationException(exp)
 
@@ -90,9 +286,6 @@ class AnnotationPropertyValues(ProxiedAccessControlledModel):
                     propertyValues["values"].update(existingDocument["values"])
                     propertyValues["_id"] = existingDocument["_id"]
 
-        # TODO(performance): create sparse index on properties if nonexisting
-        # https://docs.mongodb.com/manual/reference/operator/query/exists/
-
         return propertyValuesList
 
     def appendValues(self, creator, values, annotationId, datasetId):
@@ -101,16 +294,14 @@ class AnnotationPropertyValues(ProxiedAccessControlledModel):
             "values": values,
             "datasetId": datasetId,
         }
-        self.setUserAccess(
-            property_values, user=creator, level=AccessType.ADMIN
-        )
+        self.checkDatasetWriteAccess([property_values], creator)
+        self.setCreatorAccess(property_values, creator)
         return self.save(property_values)
 
     def appendMultipleValues(self, creator, list_of_property_values):
+        self.checkDatasetWriteAccess(list_of_property_values, creator)
         for property_values in list_of_property_values:
-            self.setUserAccess(
-                property_values, user=creator, level=AccessType.ADMIN
-            )
+            self.setCreatorAccess(property_values, creator)
         return self.saveMany(list_of_property_values)
 
     def delete(self, propertyId, datasetId):
@@ -128,15 +319,47 @@ class AnnotationPropertyValues(ProxiedAccessControlledModel):
                 self.save(document, False)
 
     def histogram(self, propertyPath, datasetId, buckets=255):
-        valueKey = "values." + propertyPath
-        match = {
-            "$match": {
-                "datasetId": datasetId,
-                # TODO(performance): sparse index see above
-                valueKey: {"$exists": True, "$ne": None},
-            }
-        }
+        self._valuePathUses[propertyPath] += 1
+        histogram, generation = self.histogramCacheModel.get(
+            datasetId, propertyPath, buckets
+        )
+        if histogram is None:
+            histogram = self.computeHistogram(propertyPath, datasetId, buckets)
+            self.histogramCacheModel.set(
+                datasetId, propertyPath, buckets, histogram, generation
+            )
+        return histogram
+
+    def histograms(self, propertyPaths, datasetId, buckets=255):
+        """
+        Get the histograms of several property paths. The histograms which are
+        not cached are computed with a single aggregation.
+
+        :returns: A dict associating each property path with its histogram
+        """
+        self._valuePathUses.update(propertyPaths)
+        histograms = {}
+        missingPaths = []
+        generation = None
+        for propertyPath in dict.fromkeys(propertyPaths):
+            histogram, generation = self.histogramCacheModel.get(
+                datasetId, propertyPath, buckets
+            )
+            if histogram is None:
+                missingPaths.append(propertyPath)
+            else:
+                histograms[propertyPath] = histogram
+        if len(missingPaths) > 0:
+            computed = self.computeHistograms(missingPaths, datasetId, buckets)
+            for propertyPath, histogram in zip(missingPaths, computed):
+                histograms[propertyPath] = histogram
+                self.histogramCacheModel.set(
+                    datasetId, propertyPath, buckets, histogram, generation
+                )
+        return histograms
 
+    @staticmethod
+    def bucketStages(valueKey, buckets):
         bucket = {
             "$bucketAuto": {"groupBy": "$" + valueKey, "buckets": buckets}
         }
@@ -150,6 +373,50 @@ class AnnotationPropertyValues(ProxiedAccessControlledModel):
             }
         }
 
-        return self.collection.aggregate([match, bucket, project])
+        return [bucket, project]
+
+    def computeHistogram(self, propertyPath, datasetId, buckets):
+        valueKey = "values." + propertyPath
+        match = {
+            "$match": {
+                "datasetId": datasetId,
+                # Uses the partial index, see ensureValueIndices
+                valueKey: {"$exists": True, "$ne": None},
+            }
+        }
+
+        return list(
+            self.collection.aggregate(
+                [match] + self.bucketStages(valueKey, buckets),
+                allowDiskUse=True,
+            )
+        )
+
+    def computeHistograms(self, propertyPaths, datasetId, buckets):
+        """
+        Compute the histograms of several property paths in a single pass on
+        the property values of the dataset, using a $facet stage
+
+        :returns: The list of histograms, in the order of propertyPaths
+        """
+        valueMatches = [
+            {"values." + propertyPath: {"$exists": True, "$ne": None}}
+            for propertyPath in propertyPaths
+        ]
+        match = {"$match": {"datasetId": datasetId, "$or": valueMatches}}
+        # Facet names can't contain dots, use the index of the path instead
+        facet = {
+            "$facet": {
+                str(i): [{"$match": valueMatch}]
+                + self.bucketStages("values." + propertyPath, buckets)
+                for i, (propertyPath, valueMatch) in enumerate(
+                    zip(propertyPaths, valueMatches)
+                )
+            }
+        }
+        result = next(
+            self.collection.aggregate([match, facet], allowDiskUse=True)
+        )
+        return [result[str(i)] for i in range(len(propertyPaths))]
 
     # def SSE for property change, sends the whole annotation
@@ -38,6 +38,7 @@ class WorkerInterfaceModel(ProxiedAccessControlledModel):
 
     def initialize(self):
         self.name = "worker_interface"
+        self.ensureIndices(["image"])
 
     def validate(self, document):
         try:
@@ -38,6 +38,7 @@ class WorkerPreviewModel(ProxiedAccessControlledModel):
 
     def initialize(self):
         self.name = "worker_preview"
+        self.ensureIndices(["image"])
 
     def validate(self, document):
         try:
@@ -0,0 +1,43 @@
+from girder.exceptions import ValidationException
+from girder.utility import setting_utilities
+
+
+# Lifetime of the history entries, their document changes and the archived
+# documents, enforced by TTL indexes
+HISTORY_LIFETIME_SECONDS = 3600
+
+
+class PluginSettings:
+    # When enabled, the access to annotations, connections and property values
+    # is the access to their dataset, and writing them requires write access
+    # on the dataset. Their creator keeps access to them once it is disabled.
+    INHERIT_DATASET_ACCESS = "upenncontrast_annotation.inherit_dataset_access"
+    # When enabled, the history entries of recorded endpoints are written in
+    # a background thread after the endpoint returns.
+    ASYNCHRONOUS_HISTORY = "upenncontrast_annotation.asynchronous_history"
+
+
+@setting_utilities.default(PluginSettings.INHERIT_DATASET_ACCESS)
+def _defaultInheritDatasetAccess():
+    return False
+
+
+@setting_utilities.validator(PluginSettings.INHERIT_DATASET_ACCESS)
+def _validateInheritDatasetAccess(doc):
+    if not isinstance(doc["value"], bool):
+        raise ValidationException(
+            "Inherit dataset access setting must be a boolean.", "value"
+        )
+
+
+@setting_utilities.default(PluginSettings.ASYNCHRONOUS_HISTORY)
+def _defaultAsynchronousHistory():
+    return False
+
+
+@setting_utilities.validator(PluginSettings.ASYNCHRONOUS_HISTORY)
+def _validateAsynchronousHistory(doc):
+    if not isinstance(doc["value"], bool):
+        raise ValidationException(
+            "Asynchronous history setting must be a boolean.", "value"
+        )
@@ -13,6 +13,7 @@ from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.upload import Upload
 from girder.models.user import User
+from girder.utility.model_importer import ModelImporter
 from girder_jobs.constants import JobStatus
 from girder_large_image.models.image_item import ImageItem
 
@@ -20,6 +21,20 @@ from girder import events, logger
 
 conversionJobs = {}
 
+# Models of the plugin which declare indexes
+indexedModelNames = [
+    "upenn_annotation",
+    "annotation_connection",
+    "annotation_property_values",
+    "annotation_property_histogram",
+    "worker_interface",
+    "worker_preview",
+    "dataset_view",
+    "history",
+    "document_change",
+    "document_archive",
+]
+
 
 def addSystemEndpoints(apiRoot):
     """
@@ -32,6 +47,8 @@ def addSystemEndpoints(apiRoot):
     apiRoot.item.route("PUT", (":itemId", "cache_maxmerge"), cacheMaxMerge)
     # Added to the folder route
     apiRoot.folder.route("GET", ("query",), getFoldersByQuery)
+    # Added to the system route
+    apiRoot.system.route("GET", ("upenn_index_stats",), getIndexStats)
 
     # Also bind some events
     events.bind(
@@ -88,6 +105,37 @@ def getFoldersByQuery(self, query, limit, offset, sort):
     )
 
 
+@access.admin
+@autoDescribeRoute(
+    Description(
+        "Get the usage of the indexes of the annotation plugin collections."
+    )
+    .notes(
+        "Uses the $indexStats aggregation stage: the number of operations "
+        "which used each index since the server started or the index was "
+        "created."
+    )
+    .errorResponse()
+)
+@boundHandler()
+def getIndexStats(self):
+    stats = {}
+    for modelName in indexedModelNames:
+        model = ModelImporter.model(modelName, "upenncontrast_annotation")
+        stats[modelName] = [
+            {
+                "name": indexStats["name"],
+                "key": indexStats["key"],
+                "ops": indexStats["accesses"]["ops"],
+                "since": indexStats["accesses"]["since"],
+            }
+            for indexStats in model.collection.aggregate(
+                [{"$indexStats": {}}]
+            )
+        ]
+    return stats
+
+
 @access.user
 @autoDescribeRoute(
     Description("Create images that cache max-merge values.")
@@ -1,6 +1,10 @@
 import pytest
 
 from girder import events
+from girder.models.setting import Setting
+
+from upenncontrast_annotation.server.helpers import fastjsonschema
+from upenncontrast_annotation.server.settings import PluginSettings
 
 
 def unbindGirderEventsByHandlerName(handlerName):
@@ -18,3 +22,23 @@ def unbindLargeImage(db):
 def unbindAnnotation(db):
     yield True
     unbindGirderEventsByHandlerName("upenncontrast_annotation")
+
+
+@pytest.fixture
+def inheritDatasetAccess(db):
+    Setting().set(PluginSettings.INHERIT_DATASET_ACCESS, True)
+    yield True
+    Setting().unset(PluginSettings.INHERIT_DATASET_ACCESS)
+
+
+@pytest.fixture
+def asynchronousHistory(db):
+    Setting().set(PluginSettings.ASYNCHRONOUS_HISTORY, True)
+    yield True
+    Setting().unset(PluginSettings.ASYNCHRONOUS_HISTORY)
+
+
+@pytest.fixture
+def schemaCacheDir(monkeypatch, tmp_path):
+    monkeypatch.setattr(fastjsonschema, "schemaCacheDir", str(tmp_path))
+    yield str(tmp_path)
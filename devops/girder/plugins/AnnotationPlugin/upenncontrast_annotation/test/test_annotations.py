@@ -1,16 +1,43 @@
+import io
+import math
+import os
+import time
+
+import numpy as np
+import orjson
 import pytest
+from fastjsonschema import JsonSchemaValueException
 
+from upenncontrast_annotation.server.helpers import export, pagination
+from upenncontrast_annotation.server.helpers import fastjsonschema
+from upenncontrast_annotation.server.helpers.fastjsonschema import (
+    customJsonSchemaCompile,
+)
+from upenncontrast_annotation.server.helpers.ingest import readLines
+from upenncontrast_annotation.server.helpers.proxiedModel import (
+    recordChanges,
+)
 from upenncontrast_annotation.server.models.annotation import Annotation
 from upenncontrast_annotation.server.models import annotation
+from upenncontrast_annotation.server.settings import PluginSettings
 
 from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.models.user import User
 
-from girder.exceptions import ValidationException
+from girder.exceptions import (
+    AccessException,
+    RestException,
+    ValidationException,
+)
 from girder.constants import AccessType
 
 from . import girder_utilities as utilities
 from . import upenn_testing_utilities as upenn_utilities
 
+# Number of annotations of the benchmarks, which are skipped when unset
+benchmarkSize = int(os.environ.get("UPENN_BENCHMARK_SIZE", 0))
+
 
 @pytest.mark.usefixtures("unbindLargeImage", "unbindAnnotation")
 @pytest.mark.plugin("upenncontrast_annotation")
@@ -81,6 +108,29 @@ class TestAnnotation:
         )
         assert result is None
 
+    def testInvalidDatasetIds(self, admin):
+        folders = [
+            utilities.createFolder(
+                admin, "sample%d" % i, upenn_utilities.datasetMetadata
+            )
+            for i in range(2)
+        ]
+        notDataset = utilities.createFolder(admin, "other", {})
+        datasetIds = [str(folder["_id"]) for folder in folders]
+        invalidIds = [str(notDataset["_id"]), "invalid"]
+        assert Annotation().invalidDatasetIds(
+            datasetIds + invalidIds
+        ) == set(invalidIds)
+        cache = Annotation().datasetIdCache
+        assert all(datasetId in cache for datasetId in datasetIds)
+
+        # Modified and removed folders are checked again
+        Folder().setMetadata(folders[0], {"subtype": "other"})
+        assert datasetIds[0] not in cache
+        assert Annotation().invalidDatasetIds(datasetIds) == {datasetIds[0]}
+        Folder().remove(folders[1])
+        assert not Annotation().isDatasetId(datasetIds[1])
+
     def testValidate(self, admin):
         sample = upenn_utilities.getSampleAnnotation(
             "012345678901234567890123"
@@ -95,3 +145,552 @@ class TestAnnotation:
         sample = upenn_utilities.getSampleAnnotation(folder["_id"])
         with pytest.raises(ValidationException, match="not a dataset"):
             Annotation().validate(sample)
+
+    def testValidateList(self):
+        validate = Annotation.jsonValidateMultiple
+        samples = [
+            upenn_utilities.getSampleAnnotation("012345678901234567890123")
+            for _ in range(4)
+        ]
+        assert validate(samples) == samples
+        del samples[1]["shape"]
+        samples[3]["coordinates"] = [{"x": 1}]
+        with pytest.raises(ValidationException) as exc:
+            Annotation().validateMultiple(samples)
+        errors = exc.value.args[0].errors
+        assert [index for index, _ in errors] == [1, 3]
+
+    @pytest.mark.skipif(
+        benchmarkSize == 0, reason="UPENN_BENCHMARK_SIZE is not set"
+    )
+    def testValidateListBenchmark(self):
+        samples = [
+            upenn_utilities.getSampleAnnotation("012345678901234567890123")
+            for _ in range(benchmarkSize)
+        ]
+        validate = Annotation.jsonValidateMultiple
+        validateItem = customJsonSchemaCompile(
+            annotation.AnnotationSchema.annotationSchema
+        )
+
+        start = time.perf_counter()
+        for sample in samples:
+            validateItem(sample)
+        loopTime = time.perf_counter() - start
+        start = time.perf_counter()
+        validate(samples)
+        listTime = time.perf_counter() - start
+        print(
+            "%d annotations: per-document loop %.3fs, list validator %.3fs"
+            % (benchmarkSize, loopTime, listTime)
+        )
+
+    def testSchemaCache(self, schemaCacheDir):
+        stats = fastjsonschema.schemaCompileStats
+        schema = annotation.AnnotationSchema.annotationSchema
+        generated, cached = stats["generated"], stats["cached"]
+        customJsonSchemaCompile(schema)
+        assert stats["generated"] == generated + 1
+        assert len(os.listdir(schemaCacheDir)) == 1
+        validate = customJsonSchemaCompile(schema)
+        assert stats["cached"] == cached + 1
+        sample = upenn_utilities.getSampleAnnotation(
+            "012345678901234567890123"
+        )
+        assert validate(sample) == sample
+        del sample["shape"]
+        with pytest.raises(JsonSchemaValueException):
+            validate(sample)
+
+        # The cache isn't read from a directory writable by others
+        os.chmod(schemaCacheDir, 0o777)
+        customJsonSchemaCompile(schema)
+        assert stats["generated"] == generated + 2
+
+    def testCentroid(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        sample = upenn_utilities.getSampleAnnotation(folder["_id"])
+        sample["shape"] = "polygon"
+        sample["coordinates"] = [
+            {"x": 0, "y": 0},
+            {"x": 4, "y": 0},
+            {"x": 4, "y": 2},
+            {"x": 0, "y": 2},
+        ]
+        annotation = Annotation().create(admin, sample)
+        loaded = Annotation().load(annotation["_id"], user=admin)
+        assert loaded["centroid"] == {"x": 2.0, "y": 1.0}
+        assert loaded["boundingBox"] == {
+            "xmin": 0.0,
+            "xmax": 4.0,
+            "ymin": 0.0,
+            "ymax": 2.0,
+        }
+
+        # The centroid follows the coordinates
+        loaded["coordinates"] = [{"x": 10, "y": 20, "z": 3}]
+        loaded["shape"] = "point"
+        Annotation().update(loaded)
+        loaded = Annotation().load(annotation["_id"], user=admin)
+        assert loaded["centroid"] == {"x": 10.0, "y": 20.0, "z": 3.0}
+
+        # Out of the index bounds, no centroid is stored
+        loaded["coordinates"] = [{"x": 2**25, "y": 0}]
+        Annotation().update(loaded)
+        loaded = Annotation().load(annotation["_id"], user=admin)
+        assert "centroid" not in loaded
+
+    def testBackfillGeometry(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        annotations = Annotation().createMultiple(
+            admin,
+            [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(5)
+            ],
+        )
+        ids = [created["_id"] for created in annotations]
+        Annotation().collection.update_many(
+            {"_id": {"$in": ids[:3]}},
+            {"$unset": {"centroid": "", "boundingBox": ""}},
+        )
+
+        progress = []
+        updated = Annotation().backfillGeometry(
+            {"datasetId": str(folder["_id"])},
+            chunkSize=2,
+            progress=lambda current, total: progress.append((current, total)),
+        )
+        assert updated == 3
+        assert progress == [(2, 3), (3, 3)]
+        for loaded in Annotation().find({"_id": {"$in": ids}}):
+            assert loaded["centroid"]["x"] == 761.152955940129
+            assert "boundingBox" in loaded
+
+    def testExport(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        samples = [
+            upenn_utilities.getSampleAnnotation(folder["_id"])
+            for _ in range(3)
+        ]
+        samples[1]["shape"] = "line"
+        samples[1]["coordinates"] = [{"x": 1, "y": 2}, {"x": 3, "y": 4}]
+        Annotation().createMultiple(admin, samples)
+
+        def exportCursor():
+            return Annotation().findWithPermissions(
+                {"datasetId": str(folder["_id"])},
+                sort=[("_id", 1)],
+                user=admin,
+                fields={"access": False},
+            )
+
+        lines = b"".join(export.ndjsonChunks(exportCursor(), 2)).splitlines()
+        exported = [orjson.loads(line) for line in lines]
+        assert [entry["name"] for entry in exported] == [
+            sample["name"] for sample in samples
+        ]
+        assert all("access" not in entry for entry in exported)
+
+        frames = list(export.binaryChunks(exportCursor(), 2))
+        assert len(frames) == 2
+        header = export.binaryFrameHeader
+        metadataLength, annotationCount, coordinateCount = header.unpack_from(
+            frames[0]
+        )
+        assert (annotationCount, coordinateCount) == (2, 3)
+        offset = header.size
+        metadata = orjson.loads(frames[0][offset:offset + metadataLength])
+        assert [entry["name"] for entry in metadata] == [
+            sample["name"] for sample in samples[:2]
+        ]
+        assert all("coordinates" not in entry for entry in metadata)
+        offset += metadataLength
+        counts = np.frombuffer(frames[0], "<u4", annotationCount, offset)
+        assert list(counts) == [1, 2]
+        offset += counts.nbytes
+        coordinates = np.frombuffer(
+            frames[0], "<f8", 3 * coordinateCount, offset
+        ).reshape(-1, 3)
+        assert coordinates[0][2] == 0
+        assert list(coordinates[2][:2]) == [3, 4]
+        assert math.isnan(coordinates[2][2])
+
+    def testCountInDataset(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        annotations = Annotation().createMultiple(
+            admin,
+            [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(3)
+            ],
+        )
+        query = {"datasetId": str(folder["_id"])}
+        assert Annotation().countInDataset(query, admin) == 3
+        assert Annotation().countInDataset(query, admin, exact=False) == 3
+
+        # Writes which don't trigger events are not seen by the estimate
+        Annotation().collection.delete_one({"_id": annotations[0]["_id"]})
+        assert Annotation().countInDataset(query, admin, exact=False) == 3
+        assert Annotation().countInDataset(query, admin) == 2
+
+        Annotation().create(
+            admin, upenn_utilities.getSampleAnnotation(folder["_id"])
+        )
+        assert Annotation().countInDataset(query, admin, exact=False) == 3
+        Annotation().deleteMultiple([str(annotations[1]["_id"])])
+        assert Annotation().countInDataset(query, admin, exact=False) == 2
+
+    def testCountInDatasetPerUser(self, user, admin):
+        folder = utilities.createFolder(
+            user, "sample", upenn_utilities.datasetMetadata
+        )
+        Annotation().create(
+            admin, upenn_utilities.getSampleAnnotation(folder["_id"])
+        )
+        Annotation().create(
+            user, upenn_utilities.getSampleAnnotation(folder["_id"])
+        )
+        query = {"datasetId": str(folder["_id"])}
+        # The count of the admin is not used for the other users
+        assert Annotation().countInDataset(query, admin) == 2
+        assert Annotation().countInDataset(query, user, exact=False) == 1
+        assert Annotation().countInDataset(query, None, exact=False) == 0
+
+    def testKeysetPagination(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        annotations = Annotation().createMultiple(
+            admin,
+            [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(5)
+            ],
+        )
+        query = {"datasetId": str(folder["_id"])}
+        pages = []
+        token = None
+        while True:
+            pageQuery, sort, offset = pagination.afterToken(
+                query, pagination.keysetSort, 0, token
+            )
+            page = list(
+                Annotation().findWithPermissions(
+                    pageQuery, sort=sort, offset=offset, limit=2, user=admin
+                )
+            )
+            pages.append([annotation["_id"] for annotation in page])
+            if len(page) < 2:
+                break
+            token = str(page[-1]["_id"])
+        ids = sorted(annotation["_id"] for annotation in annotations)
+        assert pages == [ids[0:2], ids[2:4], ids[4:5]]
+
+        # The offset is ignored when a token is given
+        assert pagination.afterToken(query, [("name", 1)], 3, token)[1:] == (
+            pagination.keysetSort,
+            0,
+        )
+        with pytest.raises(RestException):
+            pagination.afterToken(query, [("_id", 1)], 0, "invalid")
+        # Only the pages following a token, or the first one, get a token
+        keysetSort = pagination.keysetSort
+        assert pagination.isKeysetPage(keysetSort, 2, 0)
+        assert not pagination.isKeysetPage(keysetSort, 2, 4)
+        assert not pagination.isKeysetPage(keysetSort, 0, 0)
+        assert not pagination.isKeysetPage([("name", 1)], 2, 0)
+
+    def testPartialSaveMany(self, admin, monkeypatch):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        query = {"datasetId": str(folder["_id"])}
+        assert Annotation().countInDataset(query, admin, exact=False) == 0
+
+        # The last document of the second chunk has a duplicate name
+        monkeypatch.setattr(Annotation(), "saveManyChunkSize", 2)
+        Annotation().collection.create_index("name", unique=True)
+        try:
+            annotations = [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(4)
+            ]
+            for index, sample in enumerate(annotations):
+                sample["name"] = str(min(index, 2))
+            with pytest.raises(ValidationException):
+                Annotation().createMultiple(admin, annotations)
+        finally:
+            Annotation().collection.drop_index("name_1")
+
+        # The written documents invalidated the cached count
+        assert Annotation().countInDataset(query, admin, exact=False) == 3
+
+    def testUpdateMultiple(self, admin, monkeypatch):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        annotations = Annotation().createMultiple(
+            admin,
+            [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(3)
+            ],
+        )
+        monkeypatch.setattr(Annotation(), "saveManyChunkSize", 2)
+
+        with recordChanges() as recording:
+            Annotation().updateMultiple(
+                [
+                    {"id": str(created["_id"]), "name": "updated"}
+                    for created in annotations
+                ],
+                admin,
+            )
+        changes = recording.changes()["upenn_annotation"]
+
+        # The documents are replaced in place and the changes recorded
+        query = {"datasetId": str(folder["_id"])}
+        loaded = list(Annotation().find(query))
+        assert [annotation["_id"] for annotation in loaded] == [
+            annotation["_id"] for annotation in annotations
+        ]
+        assert all(annotation["name"] == "updated" for annotation in loaded)
+        for created in annotations:
+            change = changes[str(created["_id"])]
+            assert change["before"]["name"] == created["name"]
+            assert change["after"]["name"] == "updated"
+
+    def testIngest(self, admin):
+        folder = utilities.createFolder(
+            admin, "sample", upenn_utilities.datasetMetadata
+        )
+        datasetId = str(folder["_id"])
+        samples = [upenn_utilities.getSampleAnnotation(datasetId)] * 5
+        samples[1] = dict(samples[1])
+        del samples[1]["datasetId"]
+        body = io.BytesIO(
+            b"\n".join(orjson.dumps(sample) for sample in samples) + b"\n\n"
+        )
+        reads = []
+        lines = readLines(body, blockSize=100, onRead=reads.append)
+        progress = []
+        created = Annotation().ingest(
+            admin, datasetId, lines, chunkSize=2, progress=progress.append
+        )
+        assert created == 5
+        assert progress == [2, 4, 5]
+        assert reads[-1] == len(body.getvalue())
+        query = {"datasetId": datasetId}
+        assert Annotation().countInDataset(query, admin) == 5
+
+        # A chunk is either fully created or not at all
+        samples[3] = dict(samples[3], datasetId=str(admin["_id"]))
+        lines = [orjson.dumps(sample) for sample in samples]
+        with pytest.raises(ValidationException):
+            Annotation().ingest(admin, datasetId, lines, chunkSize=2)
+        assert Annotation().countInDataset(query, admin) == 7
+
+        # Lines which are not JSON objects are rejected
+        with pytest.raises(ValidationException, match="line 2"):
+            Annotation().ingest(admin, datasetId, [lines[0], b"[1, 2]"])
+        with pytest.raises(ValidationException):
+            list(readLines(io.BytesIO(b"a" * 300), 100, maxLineSize=200))
+        assert list(readLines(io.BytesIO(b"aa\nb"), 1, maxLineSize=2)) == [
+            b"aa",
+            b"b",
+        ]
+
+    @pytest.mark.usefixtures("inheritDatasetAccess")
+    def testInheritDatasetAccess(self, user, admin):
+        folder = Folder().createFolder(
+            name="sample",
+            creator=user,
+            parent=utilities.namedFolder(user, "Private"),
+        )
+        Folder().setMetadata(folder, upenn_utilities.datasetMetadata)
+        annotations = Annotation().createMultiple(
+            user,
+            [
+                upenn_utilities.getSampleAnnotation(folder["_id"])
+                for _ in range(2)
+            ],
+        )
+        other = User().createUser(
+            "other", "password", "Other", "User", "other@example.com"
+        )
+
+        query = {"datasetId": str(folder["_id"])}
+        ids = {"_id": {"$in": [created["_id"] for created in annotations]}}
+        for query in [query, ids]:
+            assert Annotation().countWithPermissions(query, user=user) == 2
+            assert Annotation().countWithPermissions(query, user=other) == 0
+        assert Annotation().load(annotations[0]["_id"], user=user) is not None
+        with pytest.raises(AccessException):
+            Annotation().load(
+                annotations[0]["_id"], user=other, level=AccessType.READ
+            )
+
+        # The access to the dataset gives access to its annotations
+        Folder().setUserAccess(folder, other, AccessType.READ, save=True)
+        assert Annotation().countWithPermissions(query, user=other) == 2
+        assert Annotation().load(
+            annotations[0]["_id"], user=other, level=AccessType.READ
+        )
+        with pytest.raises(AccessException):
+            Annotation().load(
+                annotations[0]["_id"], user=other, level=AccessType.WRITE
+            )
+
+        # Writing in a dataset requires write access on the dataset
+        sample = upenn_utilities.getSampleAnnotation(folder["_id"])
+        with pytest.raises(AccessException):
+            Annotation().create(other, dict(sample))
+        with pytest.raises(AccessException):
+            Annotation().createMultiple(other, [dict(sample)])
+        assert Annotation().countWithPermissions(query, user=user) == 2
+        otherFolder = utilities.createFolder(
+            other, "other", upenn_utilities.datasetMetadata
+        )
+        otherAnnotation = Annotation().create(
+            other, upenn_utilities.getSampleAnnotation(otherFolder["_id"])
+        )
+        # Can't move an annotation to a dataset without write access
+        moved = {"datasetId": str(folder["_id"])}
+        with pytest.raises(AccessException):
+            Annotation().update(dict(otherAnnotation, **moved), other)
+        with pytest.raises(AccessException):
+            Annotation().updateMultiple(
+                [{"id": str(otherAnnotation["_id"]), **moved}], other
+            )
+        assert Annotation().load(otherAnnotation["_id"], force=True)[
+            "datasetId"
+        ] == str(otherFolder["_id"])
+
+    @pytest.mark.usefixtures("inheritDatasetAccess")
+    def testDisableInheritDatasetAccess(self, user):
+        folder = utilities.createFolder(
+            user, "sample", upenn_utilities.datasetMetadata
+        )
+        created = Annotation().create(
+            user, upenn_utilities.getSampleAnnotation(folder["_id"])
+        )
+        # The creator keeps access to the annotation without inheritance
+        Setting().set(PluginSettings.INHERIT_DATASET_ACCESS, False)
+        assert Annotation().load(created["_id"], user=user) is not None
+        query = {"datasetId": str(folder["_id"])}
+        assert Annotation().countWithPermissions(query, user=user) == 1
+
+    def testFindInDataset(self, user, admin):
+        folder = Folder().createFolder(
+            name="sample",
+            creator=user,
+            parent=utilities.namedFolder(user, "Private"),
+        )
+        Folder().setMetadata(folder, upenn_utilities.datasetMetadata)
+        datasetId = str(folder["_id"])
+        Annotation().createMultiple(
+            user,
+            [upenn_utilities.getSampleAnnotation(datasetId) for _ in range(2)],
+        )
+        other = User().createUser(
+            "other", "password", "Other", "User", "other@example.com"
+        )
+        query = {"datasetId": datasetId}
+
+        def find(searchUser):
+            return list(
+                Annotation().findInDataset(
+                    datasetId, query, user=searchUser, fields={"access": False}
+                )
+            )
+
+        assert len(find(user)) == 2
+        assert len(find(admin)) == 2
+        assert all("access" not in annotation for annotation in find(user))
+        # Without inheritance, the access to each annotation is checked
+        assert find(other) == []
+        Folder().setUserAccess(folder, other, AccessType.READ, save=True)
+        assert find(other) == []
+
+    @pytest.mark.usefixtures("inheritDatasetAccess")
+    def testFindInDatasetInherited(self, user):
+        folder = utilities.createFolder(
+            user, "sample", upenn_utilities.datasetMetadata
+        )
+        folder = Folder().setPublic(folder, False, save=True)
+        datasetId = str(folder["_id"])
+        Annotation().create(
+            user, upenn_utilities.getSampleAnnotation(datasetId)
+        )
+        other = User().createUser(
+            "other", "password", "Other", "User", "other@example.com"
+        )
+        query = {"datasetId": datasetId}
+
+        def find(searchUser):
+            return list(
+                Annotation().findInDataset(datasetId, query, searchUser)
+            )
+
+        assert len(find(user)) == 1
+        # The access to the dataset is checked once
+        with pytest.raises(AccessException):
+            find(other)
+        Folder().setUserAccess(folder, other, AccessType.READ, save=True)
+        assert len(find(other)) == 1
+
+    @pytest.mark.skipif(
+        benchmarkSize == 0, reason="UPENN_BENCHMARK_SIZE is not set"
+    )
+    @pytest.mark.usefixtures("inheritDatasetAccess")
+    def testFindInDatasetBenchmark(self, user):
+        folder = utilities.createFolder(
+            user, "sample", upenn_utilities.datasetMetadata
+        )
+        datasetId = str(folder["_id"])
+        sample = upenn_utilities.getSampleAnnotation(datasetId)
+        for start in range(0, benchmarkSize, 10000):
+            count = min(10000, benchmarkSize - start)
+            # Store an access list as without inheritance
+            Annotation().collection.insert_many(
+                [
+                    Annotation().setUserAccess(
+                        dict(sample), user, AccessType.ADMIN, save=False
+                    )
+                    for _ in range(count)
+                ]
+            )
+        query = {"datasetId": datasetId}
+
+        def timed(find):
+            start = time.perf_counter()
+            count = sum(1 for _ in find())
+            return (count, time.perf_counter() - start)
+
+        # The per-document filter used by findWithPermissions without
+        # inheritance
+        withPermissions = timed(
+            lambda: Annotation().find(
+                {"$and": [query, Annotation().permissionClauses(user)]},
+                fields={"access": False},
+            )
+        )
+        inDataset = timed(
+            lambda: Annotation().findInDataset(
+                datasetId, query, user=user, fields={"access": False}
+            )
+        )
+        print(
+            "%d annotations: findWithPermissions %.3fs, findInDataset %.3fs"
+            % (benchmarkSize, withPermissions[1], inDataset[1])
+        )
+        assert withPermissions[0] == inDataset[0] == benchmarkSize
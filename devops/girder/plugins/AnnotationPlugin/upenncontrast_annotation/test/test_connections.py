@@ -1,13 +1,18 @@
 import pytest
 import math
+import numpy as np
 
 from upenncontrast_annotation.server.models.annotation import Annotation
 from upenncontrast_annotation.server.models.connections import (
     AnnotationConnection,
 )
 from upenncontrast_annotation.server.models import connections
+from upenncontrast_annotation.server.helpers import (
+    connections as connectionsHelpers,
+)
 from upenncontrast_annotation.server.helpers.connections import (
     annotationToAnnotationDistance,
+    nearestNeighbours,
     isAPoint,
     isAPoly,
     simpleCentroid,
@@ -188,6 +193,105 @@ class TestConnection:
         with pytest.raises(ValidationException, match="not a dataset"):
             AnnotationConnection().validate(connection)
 
+    def testConnectToNearestInTile(self, admin, monkeypatch):
+        # Force loading the whole tile, $near needs a real MongoDB
+        monkeypatch.setattr(AnnotationConnection, "nearQueryThreshold", 0)
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+
+        def createPoint(x, y, tags):
+            annotation = upenn_utilities.getSampleAnnotation(dataset["_id"])
+            annotation["coordinates"] = [{"x": x, "y": y, "z": 0}]
+            annotation["tags"] = tags
+            return Annotation().create(admin, annotation)
+
+        parents = [
+            createPoint(0, 0, ["parent"]),
+            createPoint(10, 0, ["parent"]),
+        ]
+        children = [
+            createPoint(1, 1, ["child"]),
+            createPoint(8, 1, ["child"]),
+        ]
+        # Same tag but in another tile
+        other = createPoint(1, 0, ["parent"])
+        Annotation().collection.update_one(
+            {"_id": other["_id"]}, {"$set": {"location.Z": 1}}
+        )
+        # Legacy annotation without centroid
+        legacy = createPoint(9, 4, ["parent"])
+        Annotation().collection.update_one(
+            {"_id": legacy["_id"]}, {"$unset": {"centroid": ""}}
+        )
+
+        progress = []
+        created = AnnotationConnection().connectToNearest(
+            {
+                "annotationsIds": [str(child["_id"]) for child in children],
+                "channelId": 0,
+                "tags": ["parent"],
+            },
+            user=admin,
+            progress=lambda current, total, message: progress.append(
+                (current, total)
+            ),
+        )
+        assert progress == [(0, 1), (1, 1)]
+        assert [c["childId"] for c in created] == [
+            str(child["_id"]) for child in children
+        ]
+        assert [c["parentId"] for c in created] == [
+            str(parent["_id"]) for parent in parents
+        ]
+        assert all("_id" in connection for connection in created)
+
+    def testConnectToNearestWithZ(self, admin, monkeypatch):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+
+        def createPoint(x, y, z, tags):
+            annotation = upenn_utilities.getSampleAnnotation(dataset["_id"])
+            annotation["coordinates"] = [{"x": x, "y": y, "z": z}]
+            annotation["tags"] = tags
+            return Annotation().create(admin, annotation)
+
+        # $near needs a real MongoDB, sort the candidates by XY distance
+        def findNearestCandidates(self, centroid, query, limit=16):
+            candidates = Annotation().find(
+                dict(query, centroid={"$exists": True})
+            )
+            return sorted(
+                candidates,
+                key=lambda candidate: connectionsHelpers.xyDistance(
+                    centroid, candidate["centroid"]
+                ),
+            )[:limit]
+
+        monkeypatch.setattr(
+            Annotation, "findNearestCandidates", findNearestCandidates
+        )
+        child = createPoint(0, 0, 0, ["child"])
+        # More candidates than the first index query, close in XY only
+        for i in range(AnnotationConnection.nearCandidates + 4):
+            createPoint(1 + i / 100, 0, 100, ["parent"])
+        parent = createPoint(30, 0, 0, ["parent"])
+        info = {
+            "annotationsIds": [str(child["_id"])],
+            "channelId": 0,
+            "tags": ["parent"],
+        }
+        for threshold in [AnnotationConnection.nearQueryThreshold, 0]:
+            # Centroid index, then whole tile
+            monkeypatch.setattr(
+                AnnotationConnection, "nearQueryThreshold", threshold
+            )
+            (connection,) = AnnotationConnection().connectToNearest(
+                info, user=admin
+            )
+            assert connection["parentId"] == str(parent["_id"])
+
 
 @pytest.mark.plugin("upenncontrast_annotation")
 class TestConnectToNearest:
@@ -488,3 +592,40 @@ class TestConnectToNearest:
             minDistanceToPoint, minDistanceToLine, minDistanceToBlob
         )
         assert closest == closestPoint
+
+    def testNearestCentroids(self):
+        centroids = [
+            {"x": 0, "y": 0, "z": 10},
+            {"x": 3, "y": 0},
+            {"x": 5, "y": 0, "z": 0},
+        ]
+        queries = [
+            {"x": 0, "y": 0, "z": 0},
+            {"x": 0, "y": 0},
+            {"x": 5, "y": 1, "z": 0},
+        ]
+        indices, distances = connectionsHelpers.nearestCentroids(
+            queries, centroids
+        )
+        # z is only used when both centroids have one
+        assert list(indices) == [1, 0, 2]
+        assert list(distances) == [
+            min(
+                pointToPointDistance(query, centroid)
+                for centroid in centroids
+            )
+            for query in queries
+        ]
+
+    def testNearestNeighbours(self, monkeypatch):
+        points = np.array([[0, 0], [10, 0], [5, 5]], dtype=np.float64)
+        queries = np.array([[1, 1], [9, 0], [5, 4], [6, 6]], dtype=np.float64)
+        indices, distances = nearestNeighbours(queries, points)
+        assert list(indices) == [0, 1, 2, 2]
+        assert distances[1] == 1
+
+        # numpy fallback, with small chunks
+        monkeypatch.setattr(connectionsHelpers, "cKDTree", None)
+        indices, distances = nearestNeighbours(queries, points, 1)
+        assert list(indices) == [0, 1, 2, 2]
+        assert distances[1] == 1
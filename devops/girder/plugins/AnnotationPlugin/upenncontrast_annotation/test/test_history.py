@@ -0,0 +1,519 @@
+import datetime
+import os
+import threading
+import time
+
+import cherrypy
+import pytest
+
+from upenncontrast_annotation.server.helpers import proxiedModel
+from upenncontrast_annotation.server.helpers.proxiedModel import (
+    recordable,
+    recordChanges,
+)
+from upenncontrast_annotation.server.models.annotation import Annotation
+from upenncontrast_annotation.server.models.connections import (
+    AnnotationConnection,
+)
+from upenncontrast_annotation.server.models.documentArchive import (
+    DocumentArchive,
+)
+from upenncontrast_annotation.server.models.documentChange import (
+    DocumentChange,
+)
+from upenncontrast_annotation.server.models.history import History
+from upenncontrast_annotation.server.models.propertyValues import (
+    AnnotationPropertyValues,
+)
+from upenncontrast_annotation.server.settings import HISTORY_LIFETIME_SECONDS
+
+from girder.utility.model_importer import ModelImporter
+
+from bson.objectid import ObjectId
+
+from . import girder_utilities as utilities
+from . import upenn_testing_utilities as upenn_utilities
+
+
+def recordAction(user, datasetId, action):
+    """
+    Record the changes made by action, as the recordable decorator does
+    """
+    historyId = ObjectId()
+    with recordChanges(historyId) as recording:
+        action()
+    record = recording.changes()
+    return History().submit(
+        user,
+        {
+            "_id": historyId,
+            "actionName": "test",
+            "actionDate": History.now(),
+            "userId": user["_id"],
+            "isUndone": False,
+            "datasetId": datasetId,
+        },
+        record,
+    )
+
+
+# Number of annotations of the benchmarks, which are skipped when unset
+benchmarkSize = int(os.environ.get("UPENN_BENCHMARK_SIZE", 0))
+
+
+@pytest.fixture
+def registeredModels(db):
+    # Undo and redo load the models by name, as registered by the plugin
+    ModelImporter.registerModel(
+        "upenn_annotation", Annotation, "upenncontrast_annotation"
+    )
+    ModelImporter.registerModel(
+        "annotation_property_values",
+        AnnotationPropertyValues,
+        "upenncontrast_annotation",
+    )
+    # Deleting annotations deletes their connections, whose model singleton
+    # may have been created without database by another test
+    AnnotationConnection().reconnect()
+    yield True
+
+
+def changesOf(entry):
+    return list(DocumentChange().find({"historyId": entry["_id"]}))
+
+
+@pytest.mark.usefixtures(
+    "unbindLargeImage", "unbindAnnotation", "registeredModels"
+)
+@pytest.mark.plugin("upenncontrast_annotation")
+class TestHistory:
+    def testCompactChange(self):
+        compactChange = DocumentChange.compactChange
+        assert compactChange(None, None) is None
+        assert compactChange(None, {"_id": 1}) == {"kind": "create"}
+        assert compactChange({"_id": 1}, None) == {"kind": "delete"}
+        assert compactChange({"_id": 1, "a": 1}, {"_id": 1, "a": 1}) is None
+        assert compactChange(
+            {"_id": 1, "a": 1, "b": 2, "c": 3},
+            {"_id": 1, "a": 1, "b": 4, "d": 5},
+        ) == {
+            "kind": "update",
+            "before": {"b": 2, "c": 3},
+            "after": {"b": 4, "d": 5},
+        }
+
+    def testUndoRedoCompactChanges(self, admin):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = dataset["_id"]
+        samples = [
+            upenn_utilities.getSampleAnnotation(datasetId) for _ in range(3)
+        ]
+
+        def annotationsById():
+            return {
+                annotation["_id"]: annotation
+                for annotation in Annotation().find(
+                    {"datasetId": str(datasetId)}
+                )
+            }
+
+        created = []
+        entry = recordAction(
+            admin,
+            datasetId,
+            lambda: created.extend(
+                Annotation().createMultiple(admin, samples)
+            ),
+        )
+        # Creations only reference the documents
+        changes = changesOf(entry)
+        assert len(changes) == 3
+        assert all(change["kind"] == "create" for change in changes)
+        assert all("after" not in change for change in changes)
+        afterCreation = annotationsById()
+        assert len(afterCreation) == 3
+
+        updated = dict(created[0], tags=["updated"])
+        entry = recordAction(
+            admin, datasetId, lambda: Annotation().update(updated)
+        )
+        # Updates only store the changed fields
+        (change,) = changesOf(entry)
+        assert change["kind"] == "update"
+        assert change["before"] == {"tags": created[0]["tags"]}
+        assert change["after"] == {"tags": ["updated"]}
+        afterUpdate = annotationsById()
+
+        removedIds = [str(annotation["_id"]) for annotation in created[1:]]
+        entry = recordAction(
+            admin, datasetId, lambda: Annotation().deleteMultiple(removedIds)
+        )
+        # Deletions are tombstones, the documents are archived
+        changes = changesOf(entry)
+        assert all(change["kind"] == "delete" for change in changes)
+        assert all("before" not in change for change in changes)
+        archived = DocumentArchive().collection.count_documents(
+            {"historyId": entry["_id"]}
+        )
+        assert archived == 2
+        afterDeletion = annotationsById()
+
+        for expected in [afterUpdate, afterCreation, {}]:
+            History().undo(admin, datasetId)
+            assert annotationsById() == expected
+        for expected in [afterCreation, afterUpdate, afterDeletion]:
+            History().redo(admin, datasetId)
+            assert annotationsById() == expected
+
+    def testUndoFullDocumentChanges(self, admin):
+        # Changes recorded before the compact representation
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        annotation = Annotation().create(
+            admin, upenn_utilities.getSampleAnnotation(dataset["_id"])
+        )
+        entry = recordAction(admin, dataset["_id"], lambda: None)
+        DocumentChange().collection.insert_one(
+            {
+                "historyId": entry["_id"],
+                "modelName": "upenn_annotation",
+                "documentId": annotation["_id"],
+                "before": None,
+                "after": annotation,
+            }
+        )
+        History().undo(admin, dataset["_id"])
+        assert Annotation().findOne({"_id": annotation["_id"]}) is None
+        History().redo(admin, dataset["_id"])
+        assert Annotation().findOne({"_id": annotation["_id"]}) is not None
+
+    def testRecordUpdateAndRemoveWithQuery(self, admin):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = str(dataset["_id"])
+        model = AnnotationPropertyValues()
+        model.appendMultipleValues(
+            admin,
+            [
+                {
+                    "annotationId": str(ObjectId()),
+                    "datasetId": datasetId,
+                    "values": {"area": i},
+                }
+                for i in range(3)
+            ],
+        )
+        query = {"datasetId": datasetId}
+
+        def valuesById():
+            return {
+                values["_id"]: values for values in model.find(query)
+            }
+
+        initial = valuesById()
+
+        entry = recordAction(
+            admin,
+            dataset["_id"],
+            lambda: model.update(query, {"$set": {"values.perimeter": 1}}),
+        )
+        # Only the modified top-level fields are recorded
+        changes = changesOf(entry)
+        assert len(changes) == 3
+        for change in changes:
+            assert change["kind"] == "update"
+            assert set(change["before"]) == set(change["after"]) == {
+                "values"
+            }
+            assert change["after"]["values"]["perimeter"] == 1
+        updated = valuesById()
+
+        def updateAndRemove():
+            model.update(query, {"$set": {"values.area": -1}})
+            model.removeWithQuery(query)
+
+        entry = recordAction(admin, dataset["_id"], updateAndRemove)
+        changes = changesOf(entry)
+        assert all(change["kind"] == "delete" for change in changes)
+        assert valuesById() == {}
+
+        # The archived documents are restored as they were before the action
+        History().undo(admin, dataset["_id"])
+        assert valuesById() == updated
+        History().undo(admin, dataset["_id"])
+        assert valuesById() == initial
+        History().redo(admin, dataset["_id"])
+        History().redo(admin, dataset["_id"])
+        assert valuesById() == {}
+
+    def testRecordRename(self, admin):
+        assert proxiedModel.updatedFields(
+            {"$set": {"a.b": 1}, "$rename": {"c": "d.e"}}
+        ) == {"a", "c", "d"}
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = str(dataset["_id"])
+        model = AnnotationPropertyValues()
+        model.appendValues(admin, {"area": 1}, str(ObjectId()), datasetId)
+        query = {"datasetId": datasetId}
+        initial = list(model.find(query))
+
+        recordAction(
+            admin,
+            dataset["_id"],
+            lambda: model.update(query, {"$rename": {"values": "renamed"}}),
+        )
+        assert "renamed" in model.findOne(query)
+        # The renamed field is removed by the undo
+        History().undo(admin, dataset["_id"])
+        assert list(model.find(query)) == initial
+
+    def testUndoRedoInChunks(self, admin, monkeypatch):
+        monkeypatch.setattr(History, "undoChunkSize", 2)
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = dataset["_id"]
+        samples = [
+            upenn_utilities.getSampleAnnotation(datasetId) for _ in range(5)
+        ]
+        created = []
+        recordAction(
+            admin,
+            datasetId,
+            lambda: created.extend(
+                Annotation().createMultiple(admin, samples)
+            ),
+        )
+        ids = [str(annotation["_id"]) for annotation in created]
+        recordAction(
+            admin, datasetId, lambda: Annotation().deleteMultiple(ids[:3])
+        )
+        assert History().undo(admin, datasetId)["changes"] == 3
+        summary = History().undo(admin, datasetId)
+        assert summary["isUndone"] is True
+        assert summary["changes"] == 5
+        assert summary["transaction"] is False
+        assert summary["seconds"] >= 0
+        query = {"datasetId": str(datasetId)}
+        assert Annotation().collection.count_documents(query) == 0
+        assert History().redo(admin, datasetId)["changes"] == 5
+        assert History().redo(admin, datasetId)["isUndone"] is False
+        assert Annotation().collection.count_documents(query) == 2
+        assert History().redo(admin, datasetId) is None
+
+        # Large actions are not undone in a transaction
+        monkeypatch.setattr(History, "supportsTransactions", lambda self: True)
+        monkeypatch.setattr(History, "transactionMaxChanges", 3)
+        entryIds = History().collection.distinct(
+            "_id", {"userId": admin["_id"]}
+        )
+        counts = [
+            DocumentChange().collection.count_documents({"historyId": id})
+            for id in entryIds
+        ]
+        assert sorted(counts) == [3, 5]
+        assert sorted(
+            (count, History().useTransaction(id))
+            for count, id in zip(counts, entryIds)
+        ) == [(3, True), (5, False)]
+
+    @pytest.mark.usefixtures("asynchronousHistory")
+    def testAsynchronousHistory(self, admin):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = dataset["_id"]
+        query = {"datasetId": str(datasetId)}
+        for _ in range(3):
+            recordAction(
+                admin,
+                datasetId,
+                lambda: Annotation().create(
+                    admin, upenn_utilities.getSampleAnnotation(datasetId)
+                ),
+            )
+        # Listing, undoing and redoing wait for the background writes
+        assert len(list(History().getLastEntries(admin, datasetId))) == 3
+        assert History().undo(admin, datasetId)["changes"] == 1
+        assert Annotation().collection.count_documents(query) == 2
+
+        recordAction(admin, datasetId, lambda: None)
+        assert History().writer.flush(timeout=10)
+        entries = list(History().getLastEntries(admin, datasetId))
+        # The undone entry is removed when the next entry is created
+        assert len(entries) == 3
+        assert not any(entry["isUndone"] for entry in entries)
+
+    def testSweep(self, admin):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = dataset["_id"]
+        entries = [
+            recordAction(
+                admin,
+                datasetId,
+                lambda: Annotation().create(
+                    admin, upenn_utilities.getSampleAnnotation(datasetId)
+                ),
+            )
+            for _ in range(History.maxEntriesPerUser + 2)
+        ]
+        # Entries recorded in the same millisecond would have the same date
+        for i, entry in enumerate(entries):
+            age = datetime.timedelta(seconds=len(entries) - i)
+            History().collection.update_one(
+                {"_id": entry["_id"]},
+                {"$set": {"actionDate": History.now() - age}},
+            )
+        # A document change recorded without actionDate, whose entry expired
+        legacyId = ObjectId()
+        DocumentChange().collection.insert_one(
+            {
+                "historyId": legacyId,
+                "modelName": "upenn_annotation",
+                "documentId": ObjectId(),
+                "before": None,
+                "after": None,
+            }
+        )
+        # Creating entries doesn't clean up anymore
+        assert History().collection.count_documents({}) == len(entries)
+
+        History().sweep()
+        remainingIds = set(History().collection.distinct("_id"))
+        assert remainingIds == {entry["_id"] for entry in entries[2:]}
+        changeIds = set(DocumentChange().collection.distinct("historyId"))
+        assert changeIds == remainingIds
+
+        # Expiration is done by TTL indexes
+        for model in [History(), DocumentChange()]:
+            index = model.collection.index_information()["actionDate_1"]
+            assert index["expireAfterSeconds"] == HISTORY_LIFETIME_SECONDS
+
+    def testConcurrentRecording(self, admin):
+        # Recordings of concurrent requests don't see each other's changes
+        threadCount = 8
+        actionCount = 5
+        datasets = [
+            utilities.createFolder(
+                admin, "dataset %d" % i, upenn_utilities.datasetMetadata
+            )
+            for i in range(threadCount)
+        ]
+        createdIds = [set() for _ in datasets]
+        entryIds = [[] for _ in datasets]
+        errors = []
+        barrier = threading.Barrier(threadCount)
+
+        def run(i):
+            datasetId = datasets[i]["_id"]
+            try:
+                barrier.wait()
+                for _ in range(actionCount):
+                    samples = [
+                        upenn_utilities.getSampleAnnotation(datasetId)
+                        for _ in range(10)
+                    ]
+
+                    def action():
+                        created = Annotation().createMultiple(admin, samples)
+                        createdIds[i].update(a["_id"] for a in created)
+                        Annotation().deleteMultiple(
+                            [str(a["_id"]) for a in created[:5]]
+                        )
+
+                    entry = recordAction(admin, datasetId, action)
+                    entryIds[i].append(entry["_id"])
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [
+            threading.Thread(target=run, args=(i,)) for i in range(threadCount)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+        for i in range(threadCount):
+            for entryId in entryIds[i]:
+                changes = changesOf({"_id": entryId})
+                # Created then deleted documents are not recorded
+                assert len(changes) == 5
+                assert all(change["kind"] == "create" for change in changes)
+                assert {change["documentId"] for change in changes} <= (
+                    createdIds[i]
+                )
+
+    def testRecordHistoryParameter(self, admin, monkeypatch):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        monkeypatch.setattr(proxiedModel.rest, "getCurrentUser", lambda: admin)
+
+        def create():
+            return Annotation().create(
+                admin, upenn_utilities.getSampleAnnotation(dataset["_id"])
+            )
+
+        def getDatasetId(*args):
+            return dataset["_id"]
+
+        optionalCreate = recordable(
+            "Create an annotation", getDatasetId, optional=True
+        )(create)
+        alwaysCreate = recordable("Create an annotation", getDatasetId)(create)
+
+        query = {"datasetId": dataset["_id"]}
+        monkeypatch.setattr(
+            cherrypy.request, "params", {"recordHistory": "false"}
+        )
+        optionalCreate()
+        assert History().collection.count_documents(query) == 0
+        # Only the endpoints documenting the parameter honor it
+        alwaysCreate()
+        assert History().collection.count_documents(query) == 1
+        monkeypatch.setattr(cherrypy.request, "params", {})
+        optionalCreate()
+        assert History().collection.count_documents(query) == 2
+
+    @pytest.mark.skipif(
+        benchmarkSize == 0, reason="UPENN_BENCHMARK_SIZE is not set"
+    )
+    def testRecordHistoryBenchmark(self, admin):
+        dataset = utilities.createFolder(
+            admin, "dataset", upenn_utilities.datasetMetadata
+        )
+        datasetId = dataset["_id"]
+
+        def samples():
+            return [
+                upenn_utilities.getSampleAnnotation(datasetId)
+                for _ in range(benchmarkSize)
+            ]
+
+        withoutSamples = samples()
+        start = time.perf_counter()
+        Annotation().createMultiple(admin, withoutSamples)
+        withoutTime = time.perf_counter() - start
+
+        withSamples = samples()
+        start = time.perf_counter()
+        recordAction(
+            admin,
+            datasetId,
+            lambda: Annotation().createMultiple(admin, withSamples),
+        )
+        withTime = time.perf_counter() - start
+        print(
+            "%d annotations: createMultiple %.3fs without history, "
+            "%.3fs with history" % (benchmarkSize, withoutTime, withTime)
+        )
@@ -0,0 +1,182 @@
+import pytest
+
+from upenncontrast_annotation.server.models.annotation import Annotation
+from upenncontrast_annotation.server.models.histogramCache import (
+    HistogramCache,
+)
+from upenncontrast_annotation.server.models.property import (
+    AnnotationProperty,
+)
+from upenncontrast_annotation.server.models.propertyValues import (
+    AnnotationPropertyValues,
+    valuePaths,
+)
+
+from . import girder_utilities as utilities
+from . import upenn_testing_utilities as upenn_utilities
+
+
+def createAnnotations(user, count):
+    dataset = utilities.createFolder(
+        user, "dataset", upenn_utilities.datasetMetadata
+    )
+    annotations = Annotation().createMultiple(
+        user,
+        [
+            upenn_utilities.getSampleAnnotation(dataset["_id"])
+            for _ in range(count)
+        ],
+    )
+    return (annotations, dataset)
+
+
+@pytest.mark.usefixtures("unbindLargeImage", "unbindAnnotation")
+@pytest.mark.plugin("upenncontrast_annotation")
+class TestPropertyValues:
+    def testValuePaths(self):
+        assert valuePaths({}) == []
+        assert valuePaths({"a": 1, "b": {"c": 2, "d": {"e": None}}}) == [
+            "a",
+            "b.c",
+            "b.d.e",
+        ]
+
+    def testValueIndices(self, admin):
+        (annotations, dataset) = createAnnotations(admin, 2)
+        area = AnnotationProperty().create(admin, {"name": "area"})
+        intensity = AnnotationProperty().create(admin, {"name": "intensity"})
+        areaId = str(area["_id"])
+        intensityId = str(intensity["_id"])
+        AnnotationPropertyValues().appendMultipleValues(
+            admin,
+            [
+                {
+                    "annotationId": annotation["_id"],
+                    "datasetId": str(dataset["_id"]),
+                    "values": {
+                        areaId: 2,
+                        intensityId: {"mean": 3},
+                        "unknown": 4,
+                    },
+                }
+                for annotation in annotations
+            ],
+        )
+
+        def indexedKeys():
+            return [
+                index["key"]
+                for index in (
+                    AnnotationPropertyValues()
+                    .collection.index_information()
+                    .values()
+                )
+                if "partialFilterExpression" in index
+            ]
+
+        # Saving values doesn't build indexes
+        assert indexedKeys() == []
+        assert AnnotationPropertyValues().indexKnownProperties() == 2
+        assert [("datasetId", 1), ("values." + areaId, 1)] in indexedKeys()
+        assert [
+            ("datasetId", 1),
+            ("values." + intensityId + ".mean", 1),
+        ] in indexedKeys()
+        # Only the values of known properties are indexed
+        assert len(indexedKeys()) == 2
+        # The values are not indexed with a wildcard index
+        assert all(
+            "$**" not in key
+            for index in AnnotationPropertyValues()
+            .collection.index_information()
+            .values()
+            for key, _ in index["key"]
+        )
+
+        # Removing a property drops the indexes of its values
+        AnnotationProperty().delete(area)
+        assert indexedKeys() == [
+            [("datasetId", 1), ("values." + intensityId + ".mean", 1)]
+        ]
+
+    def testValueIndicesLimit(self, admin, monkeypatch):
+        (annotations, dataset) = createAnnotations(admin, 1)
+        datasetId = str(dataset["_id"])
+        propertyIds = [
+            str(AnnotationProperty().create(admin, {"name": name})["_id"])
+            for name in ["area", "perimeter"]
+        ]
+        AnnotationPropertyValues().appendValues(
+            admin,
+            {propertyId: 1 for propertyId in propertyIds},
+            annotations[0]["_id"],
+            datasetId,
+        )
+        model = AnnotationPropertyValues()
+        monkeypatch.setattr(model, "maxValueIndices", 1)
+        assert model.indexKnownProperties() == 1
+        assert model.indexedValuePaths() == {propertyIds[0]}
+
+        # The most requested path replaces the other index
+        monkeypatch.setattr(
+            model, "computeHistogram", lambda path, datasetId, buckets: []
+        )
+        model.histogram(propertyIds[1], datasetId)
+        assert model.indexKnownProperties() == 1
+        assert model.indexedValuePaths() == {propertyIds[1]}
+
+    def testHistogramCache(self, admin, monkeypatch):
+        (annotations, dataset) = createAnnotations(admin, 2)
+        datasetId = str(dataset["_id"])
+        computed = []
+
+        def computeHistogram(propertyPath, datasetId, buckets):
+            computed.append(propertyPath)
+            return [{"min": 0, "max": 1, "count": len(computed)}]
+
+        model = AnnotationPropertyValues()
+        monkeypatch.setattr(model, "computeHistogram", computeHistogram)
+
+        first = model.histogram("area", datasetId, 10)
+        assert model.histogram("area", datasetId, 10) == first
+        assert computed == ["area"]
+        model.histogram("area", datasetId, 20)
+        assert computed == ["area", "area"]
+
+        # Saving values invalidates the histograms of the dataset
+        model.appendValues(
+            admin, {"area": 3}, annotations[0]["_id"], datasetId
+        )
+        assert model.histogram("area", datasetId, 10) != first
+        assert len(computed) == 3
+
+        # A histogram computed during an invalidation is not cached
+        histogram, generation = HistogramCache().get(datasetId, "area", 30)
+        assert histogram is None
+        HistogramCache().invalidate([datasetId])
+        HistogramCache().set(datasetId, "area", 30, first, generation)
+        assert HistogramCache().get(datasetId, "area", 30)[0] is None
+
+    def testHistograms(self, admin, monkeypatch):
+        (annotations, dataset) = createAnnotations(admin, 1)
+        datasetId = str(dataset["_id"])
+        computed = []
+
+        def computeHistograms(propertyPaths, datasetId, buckets):
+            computed.append(propertyPaths)
+            return [
+                [{"min": 0, "max": 1, "count": len(path)}]
+                for path in propertyPaths
+            ]
+
+        model = AnnotationPropertyValues()
+        monkeypatch.setattr(model, "computeHistograms", computeHistograms)
+
+        histograms = model.histograms(["a", "bb", "a"], datasetId, 10)
+        assert computed == [["a", "bb"]]
+        assert histograms["bb"] == [{"min": 0, "max": 1, "count": 2}]
+
+        # Only the missing histograms are computed
+        model.histograms(["a", "ccc"], datasetId, 10)
+        assert computed == [["a", "bb"], ["ccc"]]
+        assert model.histogram("ccc", datasetId, 10)[0]["count"] == 3